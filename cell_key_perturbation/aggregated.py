@@ -0,0 +1,102 @@
+from cell_key_perturbation.utils.perturbation_pandas import complete_grid, apply_perturbation
+from cell_key_perturbation.utils.validate_inputs_before_perturbation import validate_inputs_aggregated
+
+def create_perturbed_table_aggregated(data,
+                                      ptable,
+                                      geog,
+                                      tab_vars,
+                                      count_col = "pre_sdc_count",
+                                      rkey_sum_col = "sum_rkey",
+                                      rkey_count_col = None,
+                                      threshold = 10
+                                      ):
+    """
+    Function creates a frequency table which has has a cell key perturbation
+    technique applied with help from a p-table, starting from data that have
+    already been aggregated, e.g. by Spark or another SQL database.
+
+    The aggregated data must contain, for each combination of the geog and
+    tab_vars categories, the number of records and the sum of their record
+    keys, without any modulo applied. Given the same microdata, the result is
+    identical to create_perturbed_table().
+
+    This function applies the following steps:
+        1) Validate inputs
+        2) Complete the grid with zero-count cells
+        3) Apply modulo to the sum of record keys to obtain cell keys
+        4) Merge the frequency table with perturbation table
+        5) Apply perturbation and suppression
+
+    Parameters:
+    ----------
+    data : pandas.DataFrame
+        Aggregated data, with one column per variable and columns for the
+        number of records and the sum of record keys in each cell. Cells with
+        no records can be left out. If a cell appears in several rows (e.g.
+        partial aggregates from several partitions), the rows are added up.
+    ptable : pandas.DataFrame
+        A pandas data frame containing the 'ptable' file.
+    geog : list of str
+        A vector with one entry, the column name in 'data' that contains the
+        desired geography level for the frequency table. If no geography
+        breakdown is needed, this should be an empty vector: []
+    tab_vars : list of str
+        A vector containing the column names in 'data' of the variables to be
+        tabulated.
+    count_col : str
+        The column name in 'data' that contains the number of records in each
+        cell. Default is "pre_sdc_count".
+    rkey_sum_col : str
+        The column name in 'data' that contains the sum of record keys in
+        each cell. Records with missing record keys should be left out of the
+        sum. Default is "sum_rkey".
+    rkey_count_col : str, optional
+        The column name in 'data' that contains the number of records with a
+        record key in each cell. If supplied, the percentage of records with
+        record keys is checked in the same way as for microdata.
+        Default is None.
+    threshold : integer
+        Threshold below which cell counts are supressed. Default is 10.
+
+    Returns:
+    -------
+    aggregated_table : pandas.DataFrame
+        A frequency table which has had cell key perturbation and a threshold
+        applied, in the same format as the output of create_perturbed_table().
+
+    Examples
+    --------
+    >>> aggregated_data = spark_df.groupBy("var1", "var5", "var8").agg(
+    ...     F.count("*").alias("pre_sdc_count"),
+    ...     F.sum("record_key").alias("sum_rkey")).toPandas()
+
+    >>> perturbed_table = create_perturbed_table_aggregated(
+    ...     data = aggregated_data,
+    ...     ptable = ptable_10_5,
+    ...     geog = ["var1"],
+    ...     tab_vars = ["var5","var8"])
+    """
+    #%%# Step 1: Validate Inputs
+    validate_inputs_aggregated(data,
+                               ptable,
+                               geog,
+                               tab_vars,
+                               count_col,
+                               rkey_sum_col,
+                               rkey_count_col,
+                               threshold)
+
+    #%%# Step 2: Add up rows for the same cell and complete the grid
+    aggregated_table = (
+        data[data[count_col] > 0]
+            .groupby(geog + tab_vars)
+            .agg(pre_sdc_count = (count_col, 'sum'),
+                 sum_rkey = (rkey_sum_col, 'sum'))
+            .reset_index()
+    )
+    aggregated_table = complete_grid(aggregated_table, geog + tab_vars)
+
+    #%%# Step 3: Apply perturbation from the ptable and suppress counts less than the threshold
+    aggregated_table = apply_perturbation(aggregated_table, ptable, threshold)
+
+    return aggregated_table
@@ -1,8 +1,9 @@
 
-import pandas as pd
-
 from cell_key_perturbation.utils.perturbation_bigquery import build_perturbation_bigquery
 from cell_key_perturbation.utils.validate_inputs_before_perturbation import validate_inputs_bigquery
+from cell_key_perturbation.utils.table_writers import FILE_FORMATS, write_blocks
+from cell_key_perturbation.utils.result_cache import fingerprint_bigquery
+from cell_key_perturbation.utils.generate_record_key import record_key_sql_expression
 
 def create_perturbed_table_bigquery(client,
                                     data,
@@ -11,7 +12,8 @@ def create_perturbed_table_bigquery(client,
                                     tab_vars,
                                     record_key,
                                     use_existing_ons_id = True,
-                                    threshold = 10
+                                    threshold = 10,
+                                    cache = None
                                     ):
     """
     Function creates a frequency table which has has a cell key perturbation 
@@ -61,6 +63,11 @@ def create_perturbed_table_bigquery(client,
         Suppression threshold; cells with perturbed counts below this value
         will be suppressed (set to NULL).
         Default is 10.
+    cache : ResultCache
+        Optional cache of perturbed tables. If given, and the same query was 
+        run before on tables that have not been modified since, the table is
+        returned from the cache without running the query. 
+        Default is None, which does not use a cache.
         
     Returns:
     -------
@@ -69,25 +76,22 @@ def create_perturbed_table_bigquery(client,
         threshold applied.
     """
     
-    query = build_perturbation_bigquery(data = data,
-                                        ptable = ptable,
-                                        geog = geog,
-                                        tab_vars = tab_vars,
-                                        record_key = record_key,
-                                        threshold = threshold
-                                        )
+    query = _build_query_bigquery(client = client,
+                                  data = data,
+                                  ptable = ptable,
+                                  geog = geog,
+                                  tab_vars = tab_vars,
+                                  record_key = record_key,
+                                  use_existing_ons_id = use_existing_ons_id,
+                                  threshold = threshold
+                                  )
     
-    # Update query to generate record keys from "ons_id" if exists
-    columns = [field.name for field in client.get_table(data).schema]
-    
-    if use_existing_ons_id & ("ons_id" in columns):
-        print('NOTE: "ons_id" column is available in data!',
-              'Updating query to generate record keys from "ons_id"!')
-    
-        query = query.replace(
-            f"SAFE_CAST({record_key} AS INT64)",
-            "MOD(SAFE_CAST(ons_id AS INT64), 4096)"
-            )
+    # Return the table from the cache if it was created before
+    if cache is not None:
+        key = fingerprint_bigquery(client, data, ptable, query)
+        perturbed_table = cache.get(key)
+        if perturbed_table is not None:
+            return perturbed_table
     
     validate_inputs_bigquery(client = client,
                              data = data,
@@ -106,4 +110,158 @@ def create_perturbed_table_bigquery(client,
                        .reset_index(drop=True)
     )
     
-    return perturbed_table
\ No newline at end of file
+    if cache is not None:
+        cache.put(key, perturbed_table)
+    
+    return perturbed_table
+
+
+def write_perturbed_table_bigquery(client,
+                                   data,
+                                   ptable,
+                                   geog,
+                                   tab_vars,
+                                   record_key,
+                                   path,
+                                   file_format = "parquet",
+                                   use_existing_ons_id = True,
+                                   threshold = 10,
+                                   page_size = 1_000_000
+                                   ):
+    """
+    Function creates a frequency table which has has a cell key perturbation 
+    technique applied in BigQuery, and writes it to a file page by page, 
+    without reading the full table into memory.
+    
+    Perturbation and suppression are applied by the same SQL query as in 
+    create_perturbed_table_bigquery(). The result is downloaded in pages of 
+    at most page_size rows, and each page is written to the output file 
+    before the next one is read. The rows are not sorted.
+    
+    Parameters:
+    ----------
+    Same as for create_perturbed_table_bigquery(), plus:
+    path : str
+        Location of the output file.
+    file_format : str
+        One of "parquet", "csv" or "arrow" (Arrow IPC / Feather V2).
+        Parquet and Arrow outputs require pyarrow. Default is "parquet".
+    page_size : integer
+        Maximum number of rows downloaded and written at a time.
+        Default is 1,000,000.
+        
+    Returns:
+    -------
+    n_rows : integer
+        Number of rows written to the output file.
+    """
+    if file_format not in FILE_FORMATS:
+        raise ValueError(f"Unknown file_format '{file_format}'. "
+                         f"Expected one of {list(FILE_FORMATS)}.")
+    
+    query = _build_validated_query_bigquery(client = client,
+                                            data = data,
+                                            ptable = ptable,
+                                            geog = geog,
+                                            tab_vars = tab_vars,
+                                            record_key = record_key,
+                                            use_existing_ons_id = use_existing_ons_id,
+                                            threshold = threshold
+                                            )
+    
+    pages = (
+        client.query(query)
+              .result(page_size = page_size)
+              .to_dataframe_iterable()
+    )
+    
+    return write_blocks(pages, path, file_format)
+
+
+def _build_validated_query_bigquery(client,
+                                    data,
+                                    ptable,
+                                    geog,
+                                    tab_vars,
+                                    record_key,
+                                    use_existing_ons_id,
+                                    threshold
+                                    ):
+    """
+    Builds the perturbation query and validates the inputs in BigQuery.
+    
+    Parameters:
+    ----------
+    Same as for create_perturbed_table_bigquery().
+    
+    Returns:
+    -------
+    query : str
+        The query string to run in BigQuery.
+    """
+    query = _build_query_bigquery(client = client,
+                                  data = data,
+                                  ptable = ptable,
+                                  geog = geog,
+                                  tab_vars = tab_vars,
+                                  record_key = record_key,
+                                  use_existing_ons_id = use_existing_ons_id,
+                                  threshold = threshold
+                                  )
+    
+    validate_inputs_bigquery(client = client,
+                             data = data,
+                             ptable = ptable,
+                             geog = geog,
+                             tab_vars = tab_vars,
+                             record_key = record_key,
+                             use_existing_ons_id = use_existing_ons_id,
+                             threshold = threshold
+                             )
+    
+    return query
+
+
+def _build_query_bigquery(client,
+                          data,
+                          ptable,
+                          geog,
+                          tab_vars,
+                          record_key,
+                          use_existing_ons_id,
+                          threshold
+                          ):
+    """
+    Builds the perturbation query, updated to generate record keys from 
+    "ons_id" if it exists. Only the schema of the data is read.
+    
+    Parameters:
+    ----------
+    Same as for create_perturbed_table_bigquery().
+    
+    Returns:
+    -------
+    query : str
+        The query string to run in BigQuery.
+    """
+    query = build_perturbation_bigquery(data = data,
+                                        ptable = ptable,
+                                        geog = geog,
+                                        tab_vars = tab_vars,
+                                        record_key = record_key,
+                                        threshold = threshold
+                                        )
+    
+    # Update query to generate record keys from "ons_id" if exists
+    columns = [field.name for field in client.get_table(data).schema]
+    
+    if use_existing_ons_id & ("ons_id" in columns):
+        print('NOTE: "ons_id" column is available in data!',
+              'Updating query to generate record keys from "ons_id"!')
+    
+        query = query.replace(
+            f"SAFE_CAST({record_key} AS INT64)",
+            record_key_sql_expression()
+            )
+    
+    return query
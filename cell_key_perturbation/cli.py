@@ -0,0 +1,339 @@
+"""
+Command-line batch runner for cell key perturbation.
+
+Creates every table listed in a manifest, writes each one to Parquet, and
+records progress in a checkpoint file so that an interrupted run can be
+resumed without creating finished tables again.
+
+Usage:
+
+    cell-key-perturbation run manifest.yaml [--jobs 4] [--engine pandas]
+    cell-key-perturbation serve --data ... --ptable ...
+
+Example manifest (JSON or YAML):
+
+    engine: pandas              # or numba, numpy, bigquery
+    data: microdata.arrow       # file / directory, or BigQuery table
+    ptable: ptable_10_5_rule.csv  # CSV file, or BigQuery table
+    record_key: record_key
+    use_existing_ons_id: true
+    threshold: 10
+    output_dir: outputs
+    jobs: 4
+    drop_disclosive_columns: true
+    tables:
+      - name: la_age_sex
+        geog: [LA]
+        tab_vars: [Age, Sex]
+      - name: region_health
+        geog: [Region]
+        tab_vars: [Health]
+        threshold: 20
+"""
+
+import argparse
+import hashlib
+import json
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+
+import pandas as pd
+
+from cell_key_perturbation.create_perturbed_table import create_perturbed_table
+from cell_key_perturbation.bigquery import create_perturbed_table_bigquery
+from cell_key_perturbation.prepared_microdata import PreparedMicrodata
+from cell_key_perturbation.columnar_source import ColumnarSource
+
+ENGINES = ("pandas", "numba", "numpy", "bigquery")
+DISCLOSIVE_COLUMNS = ["pre_sdc_count", "ckey", "pcv", "pvalue"]
+CHECKPOINT_FILE = "_checkpoint.json"
+
+MANIFEST_DEFAULTS = {"engine": "pandas",
+                     "record_key": None,
+                     "use_existing_ons_id": True,
+                     "threshold": 10,
+                     "output_dir": ".",
+                     "jobs": 1,
+                     "drop_disclosive_columns": True}
+
+# Data and ptable loaded once in each worker process
+_WORKER_STATE = {}
+
+
+def read_manifest(path):
+    """
+    Reads and validates a manifest of tables, filling in default values.
+
+    Parameters
+    ----------
+    path : str
+        Location of a JSON or YAML manifest.
+
+    Returns
+    -------
+    dict
+    """
+    with open(path) as f:
+        if path.endswith((".yaml", ".yml")):
+            try:
+                import yaml
+            except ImportError as e:
+                raise ImportError("PyYAML is required to read YAML manifests. "
+                                  "Install it with: pip install pyyaml") from e
+            manifest = yaml.safe_load(f)
+        else:
+            manifest = json.load(f)
+
+    if not isinstance(manifest, dict):
+        raise TypeError("Manifest must be a mapping of settings.")
+    manifest = {**MANIFEST_DEFAULTS, **manifest}
+
+    for key in ("data", "ptable", "tables"):
+        if key not in manifest:
+            raise Exception(f"Manifest must specify '{key}'.")
+    if manifest["engine"] not in ENGINES:
+        raise Exception(f"Unknown engine '{manifest['engine']}'. "
+                        f"Expected one of {list(ENGINES)}.")
+
+    names = []
+    for spec in manifest["tables"]:
+        if not isinstance(spec, dict) or "name" not in spec:
+            raise Exception("Each table in the manifest must have a 'name'.")
+        spec.setdefault("geog", [])
+        spec.setdefault("tab_vars", [])
+        spec.setdefault("threshold", manifest["threshold"])
+        names.append(spec["name"])
+    duplicated = {name for name in names if names.count(name) > 1}
+    if duplicated:
+        raise Exception(f"Table names must be unique: {sorted(duplicated)}")
+
+    return manifest
+
+
+def run_manifest(manifest, jobs = None, engine = None):
+    """
+    Creates all tables in a manifest that are not already finished, writing
+    each to <output_dir>/<name>.parquet.
+
+    Parameters
+    ----------
+    manifest : dict
+        Manifest as returned by read_manifest().
+    jobs : integer, optional
+        Number of tables created in parallel, overriding the manifest.
+    engine : str, optional
+        "pandas", "numba", "numpy" or "bigquery", overriding the manifest.
+
+    Returns
+    -------
+    pandas.DataFrame
+        One row per table with its status and the time taken in seconds.
+    """
+    if engine is not None:
+        manifest = {**manifest, "engine": engine}
+    jobs = jobs or manifest["jobs"]
+    output_dir = manifest["output_dir"]
+    os.makedirs(output_dir, exist_ok=True)
+
+    checkpoint_path = os.path.join(output_dir, CHECKPOINT_FILE)
+    checkpoint = _read_checkpoint(checkpoint_path)
+    inputs = _input_identity(manifest)
+
+    summary = []
+    pending = []
+    for spec in manifest["tables"]:
+        spec_hash = _spec_hash(manifest, spec, inputs)
+        output_path = os.path.join(output_dir, f"{spec['name']}.parquet")
+        if checkpoint.get(spec["name"]) == spec_hash and os.path.exists(output_path):
+            summary.append({"table": spec["name"], "status": "skipped", "seconds": 0.0})
+        else:
+            pending.append((spec, spec_hash, output_path))
+
+    if manifest["engine"] == "bigquery":
+        # Queries run in BigQuery, so threads are enough to run them in parallel
+        executor = ThreadPoolExecutor(max_workers=jobs,
+                                      initializer=_init_worker,
+                                      initargs=(manifest,))
+    else:
+        executor = ProcessPoolExecutor(max_workers=jobs,
+                                       initializer=_init_worker,
+                                       initargs=(manifest,))
+
+    with executor:
+        futures = {executor.submit(_create_table, spec, output_path): (spec, spec_hash)
+                   for spec, spec_hash, output_path in pending}
+        for future in as_completed(futures):
+            spec, spec_hash = futures[future]
+            try:
+                seconds = future.result()
+            except Exception as e:
+                print(f"Table '{spec['name']}' failed: {e}", file=sys.stderr)
+                summary.append({"table": spec["name"], "status": "failed", "seconds": None})
+                continue
+            checkpoint[spec["name"]] = spec_hash
+            _write_checkpoint(checkpoint_path, checkpoint)
+            print(f"Table '{spec['name']}' written in {seconds:.1f}s")
+            summary.append({"table": spec["name"], "status": "done", "seconds": seconds})
+
+    order = {spec["name"]: i for i, spec in enumerate(manifest["tables"])}
+    summary = pd.DataFrame(summary, columns=["table", "status", "seconds"])
+    return summary.sort_values("table", key=lambda s: s.map(order)).reset_index(drop=True)
+
+
+def _init_worker(manifest):
+    """
+    Loads the data and ptable once per worker.
+    """
+    _WORKER_STATE["manifest"] = manifest
+    if manifest["engine"] == "bigquery":
+        from google.cloud import bigquery
+        _WORKER_STATE["client"] = bigquery.Client()
+        _WORKER_STATE["data"] = manifest["data"]
+        _WORKER_STATE["ptable"] = manifest["ptable"]
+    else:
+        _WORKER_STATE["data"] = _load_data(manifest["data"])
+        _WORKER_STATE["ptable"] = pd.read_csv(manifest["ptable"])
+
+
+def _load_data(path):
+    """
+    Opens microdata for the pandas, numba and numpy engines. Prepared microdata, Arrow /
+    Feather files and .npy column directories are memory-mapped; CSV and
+    Parquet files are read into memory.
+    """
+    if os.path.isfile(os.path.join(path, "metadata.json")):
+        return PreparedMicrodata.load(path)
+    if path.endswith(".csv"):
+        return pd.read_csv(path)
+    if path.endswith(".parquet"):
+        return pd.read_parquet(path)
+    return ColumnarSource(path)
+
+
+def _create_table(spec, output_path):
+    """
+    Creates one table and writes it to Parquet, returning the time taken.
+    """
+    start = time.perf_counter()
+    manifest = _WORKER_STATE["manifest"]
+    arguments = dict(data = _WORKER_STATE["data"],
+                     ptable = _WORKER_STATE["ptable"],
+                     geog = spec["geog"],
+                     tab_vars = spec["tab_vars"],
+                     record_key = manifest["record_key"],
+                     use_existing_ons_id = manifest["use_existing_ons_id"],
+                     threshold = spec["threshold"])
+
+    if manifest["engine"] == "bigquery":
+        table = create_perturbed_table_bigquery(client = _WORKER_STATE["client"],
+                                                **arguments)
+    else:
+        table = create_perturbed_table(engine = manifest["engine"], **arguments)
+
+    if manifest["drop_disclosive_columns"]:
+        table = table.drop(columns = DISCLOSIVE_COLUMNS)
+
+    # Write to a temporary file first, so an interrupted run leaves no partial output
+    tmp_path = output_path + ".tmp"
+    table.to_parquet(tmp_path, index=False)
+    os.replace(tmp_path, output_path)
+
+    return time.perf_counter() - start
+
+
+def _spec_hash(manifest, spec, inputs):
+    """
+    Fingerprint of everything that determines a table, so that a table is
+    created again if its specification or its input data change.
+    """
+    settings = {key: manifest[key] for key in
+                ("engine", "data", "ptable", "record_key",
+                 "use_existing_ons_id", "drop_disclosive_columns")}
+    settings["spec"] = spec
+    settings["inputs"] = inputs
+    return hashlib.sha256(json.dumps(settings, sort_keys=True, default=str)
+                          .encode()).hexdigest()
+
+
+def _input_identity(manifest):
+    """
+    Identifies the current version of the data and ptable: the size and
+    modification time of each file for the local engines, or the last
+    modification time of each table in BigQuery.
+    """
+    if manifest["engine"] == "bigquery":
+        from google.cloud import bigquery
+        client = bigquery.Client()
+        return {key: str(client.get_table(manifest[key]).modified)
+                for key in ("data", "ptable")}
+    return {key: _file_identity(manifest[key]) for key in ("data", "ptable")}
+
+
+def _file_identity(path):
+    """
+    Sizes and modification times of a file, or of every file in a directory.
+    """
+    if os.path.isdir(path):
+        paths = sorted(os.path.join(root, name)
+                       for root, _, names in os.walk(path) for name in names)
+    else:
+        paths = [path]
+    identity = []
+    for file_path in paths:
+        stat = os.stat(file_path)
+        identity.append([os.path.relpath(file_path, path), stat.st_size, stat.st_mtime_ns])
+    return identity
+
+
+def _read_checkpoint(path):
+    if not os.path.exists(path):
+        return {}
+    with open(path) as f:
+        return json.load(f)
+
+
+def _write_checkpoint(path, checkpoint):
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(checkpoint, f, indent=2)
+    os.replace(tmp_path, path)
+
+
+def main(argv = None):
+    parser = argparse.ArgumentParser(prog="cell-key-perturbation",
+                                     description="Cell key perturbation tools.")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    run_parser = subparsers.add_parser("run", help="Create the tables in a manifest.")
+    run_parser.add_argument("manifest", help="JSON or YAML manifest of tables.")
+    run_parser.add_argument("--jobs", type=int, default=None,
+                            help="Number of tables created in parallel.")
+    run_parser.add_argument("--engine", choices=ENGINES, default=None,
+                            help="Engine to use, overriding the manifest.")
+
+    subparsers.add_parser("serve", add_help=False,
+                          help="Run the table-builder service.")
+
+    args, remaining = parser.parse_known_args(argv)
+
+    if args.command == "serve":
+        from cell_key_perturbation.server import main as serve_main
+        return serve_main(remaining)
+
+    if remaining:
+        parser.error(f"unrecognized arguments: {' '.join(remaining)}")
+
+    manifest = read_manifest(args.manifest)
+    summary = run_manifest(manifest, jobs = args.jobs, engine = args.engine)
+
+    print("\nTiming summary:")
+    print(summary.to_string(index=False))
+    print(f"Total time creating tables: {summary['seconds'].sum():.1f}s")
+
+    return 1 if (summary["status"] == "failed").any() else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,164 @@
+import os
+
+import numpy as np
+import pandas as pd
+
+from cell_key_perturbation.utils.table_writers import import_pyarrow
+
+
+class ColumnarSource:
+    """
+    Microdata held on disk in a columnar format, read through memory maps.
+
+    The source can be either an Arrow IPC file (Feather V2, e.g. written with
+    pandas.DataFrame.to_feather()) or a directory with one .npy file per
+    column (see write_npy_columns()). Opening a source only reads its schema.
+    When a table is created, only the columns it needs are mapped into
+    memory, without copying, so several processes on the same host share a
+    single copy of the data in the operating system's page cache.
+
+    Arrow files must be written without compression, as a single record
+    batch, for numeric columns to be used in place. By default to_feather()
+    compresses with LZ4 and writes batches of 64K rows, in which case the
+    columns read are decompressed or concatenated into memory of each
+    process.
+
+    A ColumnarSource can be passed as data to create_perturbed_table(),
+    iter_perturbed_table() and write_perturbed_table().
+
+    Examples
+    --------
+    >>> micro.to_feather("micro.arrow", compression = "uncompressed",
+    ...                  chunksize = len(micro))
+    >>> source = ColumnarSource("micro.arrow")
+    >>> perturbed_table = create_perturbed_table(data = source,
+    ...                                          ptable = ptable_10_5,
+    ...                                          geog = ["var1"],
+    ...                                          tab_vars = ["var5","var8"],
+    ...                                          record_key = "record_key")
+    """
+
+    def __init__(self, path):
+        """
+        Parameters
+        ----------
+        path : str
+            Location of an Arrow IPC / Feather V2 file, or of a directory of
+            .npy column files.
+        """
+        self.path = path
+        if os.path.isdir(path):
+            self.file_format = "npy"
+            self._columns = sorted(f[:-len(".npy")] for f in os.listdir(path)
+                                   if f.endswith(".npy"))
+        elif os.path.isfile(path):
+            self.file_format = "arrow"
+            pa = import_pyarrow()
+            self._reader = pa.ipc.open_file(pa.memory_map(path, "r"))
+            self._columns = self._reader.schema.names
+        else:
+            raise FileNotFoundError(f"No columnar data found at '{path}'.")
+
+    @property
+    def columns(self):
+        return list(self._columns)
+
+    def read(self, columns):
+        """
+        Reads the given columns into a pandas data frame backed by memory
+        maps of the files, where the column types allow it.
+
+        Parameters
+        ----------
+        columns : list of str
+            Names of the columns to read.
+
+        Returns
+        -------
+        pandas.DataFrame
+        """
+        missing = [col for col in columns if col not in self._columns]
+        if missing:
+            raise Exception(f"Missing columns in '{self.path}': {missing}")
+
+        if self.file_format == "npy":
+            arrays = {col: np.load(os.path.join(self.path, f"{col}.npy"),
+                                   mmap_mode="r")
+                      for col in columns}
+            return pd.DataFrame(arrays, copy=False)
+
+        # Columns are selected batch by batch rather than after read_all(),
+        # so only the selected columns of a compressed file are kept in
+        # memory. Uncompressed batches are views of the memory map.
+        pa = import_pyarrow()
+        batches = [self._reader.get_batch(i).select(columns)
+                   for i in range(self._reader.num_record_batches)]
+        if batches:
+            table = pa.Table.from_batches(batches)
+        else:
+            table = self._reader.schema.empty_table().select(columns)
+        # split_blocks avoids consolidating columns into new 2D blocks
+        return table.to_pandas(split_blocks=True)
+
+
+def read_required_columns(source, geog, tab_vars, record_key, use_existing_ons_id):
+    """
+    Reads from a columnar source only the columns needed for a table:
+    the geog and tab_vars columns, and either the record key or "ons_id".
+    Columns that do not exist are left out, so that the usual input
+    validation reports them.
+
+    Parameters
+    ----------
+    source : ColumnarSource
+        The columnar source of the microdata.
+    geog : list of str
+        Geographic variable names.
+    tab_vars : list of str
+        Tabulation variable names.
+    record_key : str
+        Name of the record key column, or None.
+    use_existing_ons_id : Boolean
+        Whether record keys will be created from ons_id, if it exists.
+
+    Returns
+    -------
+    pandas.DataFrame
+    """
+    if use_existing_ons_id & ("ons_id" in source.columns):
+        key_columns = ["ons_id"]
+    else:
+        key_columns = [record_key]
+    required = list(dict.fromkeys(geog + tab_vars + key_columns))
+    return source.read([col for col in required if col in source.columns])
+
+
+def write_npy_columns(data, path):
+    """
+    Writes a pandas data frame to a directory with one .npy file per column,
+    which can be opened as a ColumnarSource.
+
+    String columns are stored as fixed-width unicode arrays, which can be
+    memory-mapped. Other columns must have a numpy dtype, and must not
+    contain missing values unless they are floats.
+
+    Parameters
+    ----------
+    data : pandas.DataFrame
+        The data to write.
+    path : str
+        Location of the directory, which is created if it does not exist.
+    """
+    if not isinstance(data, pd.DataFrame):
+        raise TypeError("Specified value for data must be a Pandas DataFrame.")
+    os.makedirs(path, exist_ok=True)
+
+    for col in data.columns:
+        values = data[col].to_numpy()
+        if values.dtype == object:
+            if not all(isinstance(v, str) for v in values):
+                raise TypeError(f"Column '{col}' must contain only strings "
+                                "to be written as a .npy file.")
+            values = values.astype(str)
+        np.save(os.path.join(path, f"{col}.npy"), values)
+
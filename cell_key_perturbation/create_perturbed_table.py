@@ -10,10 +10,19 @@ Noise is added from the 'ptable' file, and counts below threshold
 @author: iain dove
 """
 
-import pandas as pd
-
+from cell_key_perturbation.utils.perturbation_pandas import (
+    aggregate_microdata, complete_grid, apply_perturbation
+)
 from cell_key_perturbation.utils.validate_inputs_before_perturbation import validate_inputs
 from cell_key_perturbation.utils.generate_record_key import generate_record_key_from_ons_id
+from cell_key_perturbation.columnar_source import ColumnarSource, read_required_columns
+from cell_key_perturbation.prepared_microdata import PreparedMicrodata, create_perturbed_table_prepared
+from cell_key_perturbation.utils.result_cache import fingerprint_pandas
+from cell_key_perturbation.utils.perturbation_kernel import (
+    HAS_NUMBA, encode_columns, table_from_encoded
+)
+
+ENGINES = ("pandas", "numba", "numpy")
 
 def create_perturbed_table(data,
                            ptable,
@@ -21,7 +30,9 @@ def create_perturbed_table(data,
                            tab_vars,
                            record_key,
                            use_existing_ons_id = True,
-                           threshold = 10
+                           threshold = 10,
+                           cache = None,
+                           engine = "pandas"
                            ):
     """
     Function creates a frequency table which has has a cell key perturbation 
@@ -41,6 +52,11 @@ def create_perturbed_table(data,
     The data should contain one row per statistical 
     unit (person, household, business or other) and one column per variable 
     (age, sex, health status)
+    Alternatively, a PreparedMicrodata object, in which case record_key and 
+    use_existing_ons_id are ignored, as record keys were set when the data 
+    were prepared.
+    A ColumnarSource can also be given, in which case only the columns 
+    needed for the table are read from the memory-mapped files.
     
     ptable: Pandas data frame
     A pandas data frame containing the 'ptable' file. The ptable file 
@@ -76,6 +92,20 @@ def create_perturbed_table(data,
     The default threshold is 10. Setting threshold=0 would mean no counts are 
     supressed.
     
+    cache: ResultCache
+    Optional cache of perturbed tables. If given, a table created before 
+    from identical inputs is returned from the cache instead of being 
+    created again. Default is None, which does not use a cache.
+    
+    engine: String
+    How the table is computed. "pandas" (default) groups and merges data 
+    frames. "numba" encodes the variables as integer codes and counts, sums 
+    record keys and applies the ptable in one compiled, parallel pass; if 
+    numba is not installed, the NumPy implementation is used instead. 
+    "numpy" always uses the NumPy implementation. All engines give the same 
+    table, except that "numba" and "numpy" do not include any extra ptable 
+    columns.
+    
     Returns
     -------
     aggregated_table: Pandas data frame
@@ -118,6 +148,31 @@ def create_perturbed_table(data,
     >>> perturbed_table
 
     """
+    if engine not in ENGINES:
+        raise Exception(f"Unknown engine '{engine}'. "
+                         f"Expected one of {list(ENGINES)}.")
+    if engine == "numba" and not HAS_NUMBA:
+        print('NOTE: numba is not installed, using the "numpy" engine instead.')
+        engine = "numpy"
+
+    #%%# Return the table from the cache if it was created before
+    if cache is not None:
+        key = fingerprint_pandas(data, ptable, geog, tab_vars, record_key,
+                                 use_existing_ons_id, threshold, engine)
+        return cache.get_or_create(key, lambda: create_perturbed_table(
+            data, ptable, geog, tab_vars, record_key, use_existing_ons_id,
+            threshold, engine = engine))
+
+    #%%# Prepared microdata are already encoded and have record keys
+    if isinstance(data, PreparedMicrodata):
+        return create_perturbed_table_prepared(data, ptable, geog, tab_vars,
+                                               threshold, engine = engine)
+
+    #%%# Read only the required columns from a columnar source
+    if isinstance(data, ColumnarSource):
+        data = read_required_columns(data, geog, tab_vars, record_key,
+                                     use_existing_ons_id)
+
     #%%# Generate record keys from "ons_id" if exists
     if use_existing_ons_id & ("ons_id" in data.columns):
         print('NOTE: "ons_id" column is available in data!',
@@ -130,59 +185,20 @@ def create_perturbed_table(data,
     #%%# Step 0: Validate Inputs
     validate_inputs(data, ptable, geog, tab_vars, record_key, threshold)
     
-    #%%# Step 1: Create frequency table
-    count_df = (
-        data.groupby(geog + tab_vars)
-            .size()
-            .reset_index(name='pre_sdc_count')
-    )
-
-    aggregated_table = pd.pivot_table(count_df,
-                                      index = geog + tab_vars,
-                                      values='pre_sdc_count',                            
-                                      fill_value = 0,
-                                      dropna=False,
-                                      aggfunc = "sum").reset_index()
-    
-    #%%# Step 2: Calculate sum of the record keys and apply modulo to obtain cell keys
-    ckeys_table = (
-        data.groupby(geog + tab_vars)
-            .agg(ckey = (record_key, 'sum'))
-            .reset_index()
-    )
+    #%%# Encoded engines count, sum record keys and perturb in a single pass
+    if engine != "pandas":
+        codes, levels = encode_columns(data, geog + tab_vars)
+        record_keys = data[record_key].fillna(0).to_numpy(dtype="int64")
+        return table_from_encoded(geog + tab_vars, codes, levels, record_keys,
+                                  ptable, threshold,
+                                  use_numba = (engine == "numba"))
     
-    ckeys_table["ckey"] = ckeys_table["ckey"] % (ptable["ckey"].max() + 1)
+    #%%# Step 1: Create frequency table with the sum of record keys for each cell
+    aggregated_table = aggregate_microdata(data, geog, tab_vars, record_key)
+    aggregated_table = complete_grid(aggregated_table, geog + tab_vars)
 
-    aggregated_table = aggregated_table.merge(ckeys_table,
-                                              how ='left',
-                                              on = geog + tab_vars)
-
-    aggregated_table["ckey"] = aggregated_table["ckey"].fillna(0)
-    aggregated_table["ckey"] = aggregated_table["ckey"].astype(int)
-    
-    #%%# Step 3: Create pcv by ensuring the rows of ptable 501-750 are reused for cell values above 750
-    aggregated_table["pcv"] = aggregated_table["pre_sdc_count"]
-    aggregated_table["pcv"] = ((aggregated_table["pcv"] -1) % 250) + 501
-    aggregated_table.loc[
-        aggregated_table["pre_sdc_count"] <= 750, 
-        "pcv"
-    ] = aggregated_table["pre_sdc_count"] 
-
-    #%%# Step 4: Merge aggregated table and ptable (left join) to get perturbation value for each cell
-    aggregated_table = aggregated_table.merge(ptable, 
-                                              how ='left', 
-                                              on = ["pcv","ckey"])
-    aggregated_table["pvalue"] = aggregated_table["pvalue"].fillna(0)
-    aggregated_table["pvalue"] = aggregated_table["pvalue"].astype(int)
-
-    #%%# Step 5: Apply the perturbation and suppress counts less than the threshold
-    aggregated_table["count"] = (aggregated_table["pre_sdc_count"] 
-                                 + aggregated_table["pvalue"])
-    aggregated_table["count"] = aggregated_table["count"].astype("Int64")
-    aggregated_table.loc[
-        aggregated_table["count"] < threshold, 
-        "count"
-    ] = pd.NA
+    #%%# Step 2: Apply perturbation from the ptable and suppress counts less than the threshold
+    aggregated_table = apply_perturbation(aggregated_table, ptable, threshold)
 
     return aggregated_table
 
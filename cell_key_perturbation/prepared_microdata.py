@@ -0,0 +1,356 @@
+import json
+import os
+
+import numpy as np
+import pandas as pd
+
+from cell_key_perturbation.utils.perturbation_pandas import dense_grid_frame, apply_perturbation
+from cell_key_perturbation.utils.perturbation_kernel import (
+    HAS_NUMBA, encode_columns, table_from_encoded
+)
+from cell_key_perturbation.utils.validate_inputs_before_perturbation import validate_inputs_prepared
+from cell_key_perturbation.utils.generate_record_key import generate_record_key_from_ons_id
+
+FORMAT_VERSION = 1
+
+
+class PreparedMicrodata:
+    """
+    Microdata prepared once for repeated tabulation.
+
+    Each tabulation column is dictionary-encoded into an array of integer
+    codes, with a sorted vocabulary of its categories (-1 marks missing
+    values). The record keys, and the statistics needed to validate them,
+    are computed when the data are prepared. Creating a perturbed table from
+    prepared microdata then only needs integer arithmetic on the codes,
+    instead of grouping the original columns.
+
+    The prepared data can be saved to a directory of .npy files and opened
+    again in a later session. The arrays are memory-mapped, so opening is
+    near-instant and only the columns used by a table are read from disk.
+
+    Attributes
+    ----------
+    columns : list of str
+        Names of the encoded tabulation columns.
+    record_key : str
+        Name of the record key column the keys were taken from.
+    stats : dict
+        Number of records, number of missing record keys, and the minimum and
+        maximum record key.
+
+    Examples
+    --------
+    >>> prepared = PreparedMicrodata.from_dataframe(micro,
+    ...                                             record_key = "record_key")
+    >>> prepared.save("micro_prepared")
+
+    # in a later session
+    >>> prepared = PreparedMicrodata.load("micro_prepared")
+    >>> perturbed_table = create_perturbed_table(data = prepared,
+    ...                                          ptable = ptable_10_5,
+    ...                                          geog = ["var1"],
+    ...                                          tab_vars = ["var5","var8"],
+    ...                                          record_key = None)
+    """
+
+    def __init__(self, codes, levels, record_keys, record_key, stats):
+        """
+        Parameters
+        ----------
+        codes : dict of numpy.ndarray
+            Integer codes of each column, -1 for missing values.
+        levels : dict of pandas.Index
+            Sorted categories of each column, indexed by the codes.
+        record_keys : numpy.ndarray
+            Integer record keys, with 0 for missing record keys.
+        record_key : str
+            Name of the record key column.
+        stats : dict
+            Statistics on the record keys, see the class attributes.
+        """
+        self._codes = codes
+        self._levels = levels
+        self._record_keys = record_keys
+        self.record_key = record_key
+        self.stats = stats
+
+    @property
+    def columns(self):
+        return list(self._codes)
+
+    @property
+    def record_keys(self):
+        return self._record_keys
+
+    def codes(self, column):
+        """
+        Returns the integer codes of a column, -1 for missing values.
+        """
+        return self._codes[column]
+
+    def levels(self, column):
+        """
+        Returns the sorted categories of a column, indexed by its codes.
+        """
+        return self._levels[column]
+
+    def __len__(self):
+        return len(self._record_keys)
+
+    @classmethod
+    def from_dataframe(cls,
+                       data,
+                       record_key,
+                       columns = None,
+                       use_existing_ons_id = True):
+        """
+        Prepares microdata held in a pandas data frame.
+
+        Parameters
+        ----------
+        data : pandas.DataFrame
+            Microdata with one row per statistical unit.
+        record_key : str
+            The column name in 'data' that contains the record keys. Set
+            (record_key = None) if record keys will be generated from "ons_id".
+        columns : list of str, optional
+            Columns to encode for tabulation. Default is None, which encodes
+            all columns except the record key and "ons_id".
+        use_existing_ons_id : Boolean
+            Whether to create record keys from ons_id, if ons_id exists in
+            data. Default is True.
+
+        Returns
+        -------
+        PreparedMicrodata
+        """
+        if not isinstance(data, pd.DataFrame):
+            raise TypeError("Specified value for data must be a Pandas DataFrame.")
+
+        #%%# Generate record keys from "ons_id" if exists
+        if use_existing_ons_id & ("ons_id" in data.columns):
+            print('NOTE: "ons_id" column is available in data!',
+                  'Generating record keys from "ons_id"!')
+
+            data = generate_record_key_from_ons_id(data,
+                                                   record_key_col="ons_record_key")
+            record_key = "ons_record_key"
+
+        if record_key not in data.columns:
+            raise Exception("Specified value for record_key must be a column in data.")
+        if columns is None:
+            columns = [col for col in data.columns
+                       if col not in (record_key, "ons_id", "ons_record_key")]
+        missing = [col for col in columns if col not in data.columns]
+        if missing:
+            raise Exception(f"Missing columns in data: {missing}")
+
+        #%%# Encode each tabulation column as integer codes
+        col_codes, col_levels = encode_columns(data, columns)
+        codes = {col: c.astype(np.int32) for col, c in zip(columns, col_codes)}
+        levels = dict(zip(columns, col_levels))
+
+        #%%# Record keys and the statistics used for validation
+        keys = data[record_key]
+        stats = {"n_records": int(len(keys)),
+                 "rkey_nan_count": int(keys.isna().sum()),
+                 "min_rkey": _to_python(keys.min()),
+                 "max_rkey": _to_python(keys.max())}
+        record_keys = keys.fillna(0).to_numpy(dtype=np.int64)
+
+        return cls(codes, levels, record_keys, record_key, stats)
+
+    def save(self, path):
+        """
+        Saves the prepared microdata to a directory, which is created if it
+        does not exist.
+
+        Parameters
+        ----------
+        path : str
+            Location of the directory.
+        """
+        os.makedirs(path, exist_ok=True)
+
+        column_meta = []
+        for i, col in enumerate(self.columns):
+            level_values = self._levels[col].to_numpy()
+            if level_values.dtype == object:
+                if not all(isinstance(v, str) for v in level_values):
+                    raise TypeError(f"Column '{col}' must contain only strings "
+                                    "or only numbers to be saved.")
+                level_values = level_values.astype(str)
+            np.save(os.path.join(path, f"codes_{i}.npy"), self._codes[col])
+            np.save(os.path.join(path, f"levels_{i}.npy"), level_values)
+            column_meta.append({"name": col,
+                                "dtype": str(self._levels[col].dtype)})
+
+        np.save(os.path.join(path, "record_keys.npy"), self._record_keys)
+
+        metadata = {"format_version": FORMAT_VERSION,
+                    "columns": column_meta,
+                    "record_key": self.record_key,
+                    "stats": self.stats}
+        with open(os.path.join(path, "metadata.json"), "w") as f:
+            json.dump(metadata, f, indent=2)
+
+    @classmethod
+    def load(cls, path):
+        """
+        Opens prepared microdata saved with save(). The codes and record keys
+        are memory-mapped rather than read into memory.
+
+        Parameters
+        ----------
+        path : str
+            Location of the directory.
+
+        Returns
+        -------
+        PreparedMicrodata
+        """
+        with open(os.path.join(path, "metadata.json")) as f:
+            metadata = json.load(f)
+        if metadata["format_version"] != FORMAT_VERSION:
+            raise Exception(f"Unsupported prepared data format version "
+                            f"{metadata['format_version']}.")
+
+        codes = {}
+        levels = {}
+        for i, col in enumerate(metadata["columns"]):
+            codes[col["name"]] = np.load(os.path.join(path, f"codes_{i}.npy"),
+                                         mmap_mode="r")
+            level_values = np.load(os.path.join(path, f"levels_{i}.npy"))
+            levels[col["name"]] = pd.Index(level_values, dtype=col["dtype"])
+
+        record_keys = np.load(os.path.join(path, "record_keys.npy"),
+                              mmap_mode="r")
+
+        return cls(codes, levels, record_keys,
+                   metadata["record_key"], metadata["stats"])
+
+    def aggregate(self, variables):
+        """
+        Counts records and sums record keys for every combination of
+        categories of the given variables.
+
+        Records with a missing value in any of the variables are left out,
+        and only categories that appear in the remaining records are kept, in
+        the same way as grouping the original data.
+
+        Parameters
+        ----------
+        variables : list of str
+            Encoded columns to cross-tabulate.
+
+        Returns
+        -------
+        levels : list of pandas.Index
+            Sorted categories of each variable.
+        pre_sdc_count : numpy.ndarray
+            Number of records in each cell, in the sorted order of the grid.
+        sum_rkey : numpy.ndarray
+            Sum of record keys in each cell.
+        """
+        codes = [np.asarray(self._codes[v]) for v in variables]
+        shape = tuple(len(self._levels[v]) for v in variables)
+
+        valid = np.ones(len(self), dtype=bool)
+        for col_codes in codes:
+            valid &= col_codes >= 0
+        cell_index = np.ravel_multi_index([c[valid] for c in codes], shape)
+
+        grid_size = int(np.prod(shape))
+        pre_sdc_count = np.bincount(cell_index, minlength=grid_size)
+        # Sums of integer keys are exact in float64 well beyond any table size
+        sum_rkey = np.bincount(cell_index,
+                               weights=np.asarray(self._record_keys)[valid],
+                               minlength=grid_size)
+        sum_rkey = np.rint(sum_rkey).astype(np.int64)
+
+        # Keep only the categories present in the tabulated records
+        pre_sdc_count = pre_sdc_count.reshape(shape)
+        sum_rkey = sum_rkey.reshape(shape)
+        present = []
+        for axis in range(len(shape)):
+            other_axes = tuple(a for a in range(len(shape)) if a != axis)
+            present.append(np.flatnonzero(pre_sdc_count.sum(axis=other_axes)))
+        subset = np.ix_(*present)
+
+        levels = [self._levels[v].take(keep)
+                  for v, keep in zip(variables, present)]
+        return (levels,
+                pre_sdc_count[subset].ravel().astype(np.int64),
+                sum_rkey[subset].ravel())
+
+
+def create_perturbed_table_prepared(prepared,
+                                    ptable,
+                                    geog,
+                                    tab_vars,
+                                    threshold = 10,
+                                    engine = "pandas"):
+    """
+    Function creates a frequency table which has has a cell key perturbation
+    technique applied with help from a p-table, from prepared microdata.
+
+    The result is identical to calling create_perturbed_table() on the
+    microdata the prepared data were created from. create_perturbed_table()
+    calls this function when it is given a PreparedMicrodata object.
+
+    Parameters
+    ----------
+    prepared : PreparedMicrodata
+        The prepared microdata.
+    ptable : pandas.DataFrame
+        A pandas data frame containing the 'ptable' file.
+    geog : list of str
+        A vector with one entry, the desired geography level, or [].
+    tab_vars : list of str
+        A vector containing the names of the variables to be tabulated.
+    threshold : integer
+        Threshold below which cell counts are supressed. Default is 10.
+    engine : str
+        "pandas" (default) aggregates with NumPy and merges the ptable;
+        "numba" or "numpy" aggregate and perturb in a single pass, see
+        create_perturbed_table().
+
+    Returns
+    -------
+    aggregated_table : pandas.DataFrame
+        A frequency table which has had cell key perturbation and a threshold
+        applied.
+    """
+    #%%# Step 0: Validate Inputs
+    validate_inputs_prepared(prepared, ptable, geog, tab_vars, threshold)
+
+    #%%# Encoded engines count, sum record keys and perturb in a single pass
+    if engine != "pandas":
+        variables = geog + tab_vars
+        return table_from_encoded(variables,
+                                  [prepared.codes(v) for v in variables],
+                                  [prepared.levels(v) for v in variables],
+                                  prepared.record_keys,
+                                  ptable,
+                                  threshold,
+                                  use_numba = (engine == "numba") and HAS_NUMBA)
+
+    #%%# Step 1: Create frequency table with the sum of record keys for each cell
+    levels, pre_sdc_count, sum_rkey = prepared.aggregate(geog + tab_vars)
+    aggregated_table = dense_grid_frame(geog + tab_vars, levels,
+                                        pre_sdc_count, sum_rkey)
+
+    #%%# Step 2: Apply perturbation from the ptable and suppress counts less than the threshold
+    aggregated_table = apply_perturbation(aggregated_table, ptable, threshold)
+
+    return aggregated_table
+
+
+def _to_python(value):
+    """
+    Converts a numpy scalar to a Python number, so it can be saved as JSON.
+    """
+    if pd.isna(value):
+        return float("nan")
+    return value.item() if hasattr(value, "item") else value
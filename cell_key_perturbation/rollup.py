@@ -0,0 +1,229 @@
+from cell_key_perturbation.utils.perturbation_pandas import (
+    aggregate_microdata, complete_grid, apply_perturbation
+)
+from cell_key_perturbation.utils.validate_inputs_before_perturbation import (
+    validate_inputs, validate_inputs_aggregated, validate_geog_lookup
+)
+from cell_key_perturbation.utils.generate_record_key import generate_record_key_from_ons_id
+
+def create_perturbed_tables_rollup(data,
+                                   ptable,
+                                   finest_geog,
+                                   geog_lookup,
+                                   geog_levels,
+                                   tab_vars,
+                                   record_key,
+                                   use_existing_ons_id = True,
+                                   threshold = 10
+                                   ):
+    """
+    Function creates perturbed frequency tables at several geography levels,
+    e.g. OA, LSOA, LA and Region, reading the microdata only once.
+
+    The microdata are aggregated at the finest geography level. As counts
+    and sums of record keys are additive, the tables for coarser levels are
+    then produced exactly from the finest level using a geography lookup,
+    without re-reading the microdata. Each table is identical to the output
+    of create_perturbed_table() with geog = [level], provided the lookup
+    agrees with any geography columns in the microdata. An error is raised
+    if any record has no code for the finest level, or if the lookup has no
+    code at some level for a finest code in the data, as these records would
+    be left out of the coarser tables.
+
+    Parameters
+    ----------
+    data : Pandas data frame
+    A pandas data frame containing the data to be tabulated and perturbed.
+    Every record must have a code for the finest geography level.
+
+    ptable: Pandas data frame
+    A pandas data frame containing the 'ptable' file.
+
+    finest_geog: String
+    The column name in 'data' and 'geog_lookup' of the finest geography
+    level. For example "OA".
+
+    geog_lookup: Pandas data frame
+    A lookup with one column per geography level, mapping each code of the
+    finest level to a single code at each coarser level.
+
+    geog_levels: Vector
+    The column names in 'geog_lookup' of the geography levels to produce
+    tables for. For example ["OA", "LSOA", "LA", "Region"].
+
+    tab_vars: Vector
+    A vector containing the column names in 'data' of the variables to be
+    tabulated.
+
+    record_key: String
+    The column name in 'data' that contains the record keys required for
+    perturbation. Set (record_key = None) if record keys will be generated
+    from "ons_id".
+
+    use_existing_ons_id: Boolean
+    Whether to create record keys from ons_id, if ons_id exists in data.
+    Default is True.
+
+    threshold: Integer
+    Threshold below which cell counts are supressed. Default is 10.
+
+    Returns
+    -------
+    perturbed_tables: Dictionary
+    A perturbed frequency table for each geography level, keyed by the
+    column name of the level.
+
+    Examples
+    --------
+    >>> perturbed_tables = create_perturbed_tables_rollup(
+    ...     data = micro,
+    ...     ptable = ptable_10_5,
+    ...     finest_geog = "OA",
+    ...     geog_lookup = oa_lookup,
+    ...     geog_levels = ["OA", "LSOA", "LA", "Region"],
+    ...     tab_vars = ["Age", "Sex"],
+    ...     record_key = "record_key")
+
+    >>> perturbed_tables["LA"]
+    """
+    #%%# Generate record keys from "ons_id" if exists
+    if use_existing_ons_id & ("ons_id" in data.columns):
+        print('NOTE: "ons_id" column is available in data!',
+              'Generating record keys from "ons_id"!')
+
+        data = generate_record_key_from_ons_id(data,
+                                               record_key_col="ons_record_key")
+        record_key = "ons_record_key"
+
+    #%%# Step 0: Validate Inputs
+    validate_inputs(data, ptable, [finest_geog], tab_vars, record_key, threshold)
+    validate_geog_lookup(geog_lookup, finest_geog, geog_levels,
+                         data[finest_geog].unique())
+
+    #%%# Step 1: Aggregate the microdata at the finest geography level
+    aggregated_table = aggregate_microdata(data, [finest_geog], tab_vars, record_key)
+
+    #%%# Step 2: Roll up to each geography level and apply perturbation
+    return _rollup(aggregated_table,
+                   ptable,
+                   finest_geog,
+                   geog_lookup,
+                   geog_levels,
+                   tab_vars,
+                   threshold)
+
+
+def rollup_perturbed_tables(aggregated_data,
+                            ptable,
+                            finest_geog,
+                            geog_lookup,
+                            geog_levels,
+                            tab_vars,
+                            count_col = "pre_sdc_count",
+                            rkey_sum_col = "sum_rkey",
+                            threshold = 10
+                            ):
+    """
+    Function creates perturbed frequency tables at several geography levels
+    from data already aggregated at the finest geography level.
+
+    The aggregated data need one row per cell with the number of records and
+    the sum of record keys, without any modulo applied, as for
+    create_perturbed_table_aggregated().
+
+    Parameters
+    ----------
+    aggregated_data: Pandas data frame
+    Data aggregated by finest_geog and tab_vars, with columns for the number
+    of records and the sum of record keys in each cell.
+
+    count_col: String
+    The column name in 'aggregated_data' that contains the number of records
+    in each cell. Default is "pre_sdc_count".
+
+    rkey_sum_col: String
+    The column name in 'aggregated_data' that contains the sum of record keys
+    in each cell. Default is "sum_rkey".
+
+    Other parameters are the same as for create_perturbed_tables_rollup().
+
+    Returns
+    -------
+    perturbed_tables: Dictionary
+    A perturbed frequency table for each geography level, keyed by the
+    column name of the level.
+    """
+    #%%# Step 0: Validate Inputs
+    validate_inputs_aggregated(aggregated_data,
+                               ptable,
+                               [finest_geog],
+                               tab_vars,
+                               count_col,
+                               rkey_sum_col,
+                               None,
+                               threshold)
+    validate_geog_lookup(geog_lookup, finest_geog, geog_levels,
+                         aggregated_data[finest_geog].unique())
+
+    aggregated_table = (
+        aggregated_data[aggregated_data[count_col] > 0]
+            .groupby([finest_geog] + tab_vars)
+            .agg(pre_sdc_count = (count_col, 'sum'),
+                 sum_rkey = (rkey_sum_col, 'sum'))
+            .reset_index()
+    )
+
+    #%%# Step 1: Roll up to each geography level and apply perturbation
+    return _rollup(aggregated_table,
+                   ptable,
+                   finest_geog,
+                   geog_lookup,
+                   geog_levels,
+                   tab_vars,
+                   threshold)
+
+
+def _rollup(aggregated_table,
+            ptable,
+            finest_geog,
+            geog_lookup,
+            geog_levels,
+            tab_vars,
+            threshold):
+    """
+    Rolls up a table aggregated at the finest geography level to each
+    geography level, then completes the grid and applies perturbation.
+
+    Parameters
+    ----------
+    aggregated_table: Pandas data frame
+    Table with columns finest_geog, tab_vars, 'pre_sdc_count' and 'sum_rkey'.
+
+    Other parameters are the same as for create_perturbed_tables_rollup().
+
+    Returns
+    -------
+    perturbed_tables: Dictionary
+    A perturbed frequency table for each geography level.
+    """
+    coarser_levels = [level for level in dict.fromkeys(geog_levels)
+                      if level != finest_geog]
+    lookup = geog_lookup[[finest_geog] + coarser_levels].drop_duplicates()
+    aggregated_table = aggregated_table.merge(lookup,
+                                              how = 'left',
+                                              on = finest_geog)
+
+    perturbed_tables = {}
+    for level in geog_levels:
+        level_table = (
+            aggregated_table.groupby([level] + tab_vars)
+                            .agg(pre_sdc_count = ('pre_sdc_count', 'sum'),
+                                 sum_rkey = ('sum_rkey', 'sum'))
+                            .reset_index()
+        )
+        level_table = complete_grid(level_table, [level] + tab_vars)
+        perturbed_tables[level] = apply_perturbation(level_table,
+                                                     ptable,
+                                                     threshold)
+
+    return perturbed_tables
@@ -0,0 +1,310 @@
+"""
+Local table-builder service. The microdata are loaded, prepared and
+validated once at startup, together with the ptable, and perturbed tables are
+then returned over HTTP with low latency.
+
+Run from the command line, for example:
+
+    python -m cell_key_perturbation.server --data microdata_prepared
+        --ptable ptable_10_5_rule.csv --port 8080
+
+and request a table with:
+
+    curl -X POST localhost:8080/table
+        -d '{"geog": ["var1"], "tab_vars": ["var5", "var8"], "threshold": 10}'
+"""
+
+import argparse
+import json
+import os
+import socketserver
+import stat
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import numpy as np
+import pandas as pd
+
+from cell_key_perturbation.prepared_microdata import PreparedMicrodata
+from cell_key_perturbation.columnar_source import ColumnarSource
+from cell_key_perturbation.utils.perturbation_pandas import (
+    dense_grid_frame, compile_ptable, calculate_pcv, lookup_pvalue, suppress
+)
+from cell_key_perturbation.utils.validate_inputs_before_perturbation import (
+    _check_input_arguments, _check_key_range, _check_missing_record_key,
+    _record_key_percent
+)
+
+
+class TableBuilder:
+    """
+    Creates perturbed tables from microdata prepared once.
+
+    Only the variables and the perturbed 'count' column are returned, so
+    the disclosive columns never leave the service.
+
+    Examples
+    --------
+    >>> builder = TableBuilder(prepared, ptable_10_5, max_cells = 1_000_000)
+    >>> table = builder.build(geog = ["var1"], tab_vars = ["var5","var8"])
+    """
+
+    def __init__(self, prepared, ptable, max_cells = 1_000_000, min_threshold = 10):
+        """
+        Parameters
+        ----------
+        prepared : PreparedMicrodata
+            The prepared microdata.
+        ptable : pandas.DataFrame
+            A pandas data frame containing the 'ptable' file.
+        max_cells : integer
+            Maximum number of cells in a requested table. Default is 1,000,000.
+        min_threshold : integer
+            Lowest threshold a request may use. Default is 10.
+        """
+        if not isinstance(prepared, PreparedMicrodata):
+            raise TypeError("Specified value for prepared must be a PreparedMicrodata object.")
+        if not isinstance(ptable, pd.DataFrame):
+            raise TypeError("Specified value for ptable must be a Pandas DataFrame.")
+        required_ptable_cols = {"pcv", "ckey", "pvalue"}
+        if not required_ptable_cols.issubset(ptable.columns):
+            raise Exception("Supplied ptable must contain columns named 'pcv', 'ckey' and 'pvalue'.")
+
+        # Record keys do not depend on the request, so are checked once
+        stats = prepared.stats
+        _check_key_range(ptable["ckey"].min(), ptable["ckey"].max(),
+                         stats["min_rkey"], stats["max_rkey"])
+        rkey_nan_count = stats["rkey_nan_count"]
+        _check_missing_record_key(rkey_nan_count,
+                                  _record_key_percent(rkey_nan_count, stats["n_records"]))
+
+        self.prepared = prepared
+        self.pvalues = compile_ptable(ptable)
+        self.max_cells = max_cells
+        self.min_threshold = min_threshold
+
+    def build(self, geog, tab_vars, threshold = 10):
+        """
+        Creates a perturbed table. The counts are identical to those from
+        create_perturbed_table() on the same microdata.
+
+        Parameters
+        ----------
+        geog : list of str
+            A vector with one entry, the desired geography level, or [].
+        tab_vars : list of str
+            A vector containing the names of the variables to be tabulated.
+        threshold : integer
+            Threshold below which cell counts are supressed. Default is 10.
+
+        Returns
+        -------
+        pandas.DataFrame
+            The variables and the perturbed 'count' column.
+        """
+        _check_input_arguments(geog, tab_vars, self.prepared.record_key, threshold)
+        variables = geog + tab_vars
+        missing = [v for v in variables if v not in self.prepared.columns]
+        if missing:
+            raise Exception(f"Unknown variable(s): {missing}")
+        if len(set(variables)) < len(variables):
+            raise Exception("Each variable can only be tabulated once.")
+        if threshold < self.min_threshold:
+            raise Exception(f"Threshold must be at least {self.min_threshold}.")
+
+        # Upper bound of the grid size, known before any data are read
+        n_cells = int(np.prod([len(self.prepared.levels(v)) for v in variables]))
+        if n_cells > self.max_cells:
+            raise Exception(f"Table would have up to {n_cells} cells, more "
+                            f"than the limit of {self.max_cells}.")
+
+        levels, pre_sdc_count, sum_rkey = self.prepared.aggregate(variables)
+        table = dense_grid_frame(variables, levels, pre_sdc_count, sum_rkey)
+
+        ckey = (sum_rkey % self.pvalues.shape[1]).astype(int)
+        pvalue = lookup_pvalue(self.pvalues, calculate_pcv(pre_sdc_count), ckey)
+        table["count"] = suppress(pre_sdc_count + pvalue, threshold)
+
+        return table[variables + ["count"]]
+
+
+def create_server(builder,
+                  host = "127.0.0.1",
+                  port = 8080,
+                  socket_path = None,
+                  max_concurrent = 4):
+    """
+    Creates an HTTP server answering table requests with a TableBuilder.
+
+    Endpoints:
+        - GET /health: returns the variables available for tabulation
+        - POST /table: takes a JSON body with "geog", "tab_vars" and
+        optionally "threshold", and returns the table as JSON with
+        "columns" and "data" entries
+
+    Requests are handled in separate threads. When max_concurrent tables are
+    already being built, further requests are refused with status 503.
+
+    Parameters
+    ----------
+    builder : TableBuilder
+        Creates the tables.
+    host : str
+        Address to listen on. Default is "127.0.0.1", the local machine only.
+    port : integer
+        Port to listen on. Default is 8080.
+    socket_path : str, optional
+        If given, listen on this Unix socket instead of host and port. An
+        existing socket at this path is replaced; any other file is an error.
+    max_concurrent : integer
+        Maximum number of tables built at the same time. Default is 4.
+
+    Returns
+    -------
+    Server object; call serve_forever() to start answering requests.
+    """
+    slots = threading.BoundedSemaphore(max_concurrent)
+
+    class Handler(_TableRequestHandler):
+        pass
+    Handler.builder = builder
+    Handler.slots = slots
+
+    if socket_path is not None:
+        # Only a socket left by a previous run is replaced, never another file
+        if os.path.exists(socket_path):
+            if not stat.S_ISSOCK(os.stat(socket_path).st_mode):
+                raise Exception(f"'{socket_path}' already exists and is not a socket.")
+            os.remove(socket_path)
+        return _UnixHTTPServer(socket_path, Handler)
+    return ThreadingHTTPServer((host, port), Handler)
+
+
+class _UnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+class _TableRequestHandler(BaseHTTPRequestHandler):
+    """
+    Handles requests to the table-builder service.
+    """
+    builder = None
+    slots = None
+
+    def address_string(self):
+        # Unix socket clients have no address
+        return self.client_address[0] if self.client_address else "unix-socket"
+
+    def do_GET(self):
+        if self.path != "/health":
+            return self._send_json(404, {"error": "Not found."})
+        self._send_json(200, {"status": "ok",
+                              "columns": self.builder.prepared.columns})
+
+    def do_POST(self):
+        if self.path != "/table":
+            return self._send_json(404, {"error": "Not found."})
+        try:
+            length = int(self.headers.get("Content-Length", 0))
+            spec = json.loads(self.rfile.read(length) or b"{}")
+            geog = spec.get("geog", [])
+            tab_vars = spec.get("tab_vars", [])
+            threshold = spec.get("threshold", 10)
+        except (ValueError, AttributeError):
+            return self._send_json(400, {"error": "Request body must be a JSON object."})
+
+        if not self.slots.acquire(blocking=False):
+            return self._send_json(503, {"error": "Too many concurrent requests."})
+        try:
+            table = self.builder.build(geog, tab_vars, threshold)
+        except Exception as e:
+            return self._send_json(400, {"error": str(e)})
+        finally:
+            self.slots.release()
+
+        self._send_body(200, table.to_json(orient="split", index=False))
+
+    def _send_json(self, status, body):
+        self._send_body(status, json.dumps(body))
+
+    def _send_body(self, status, body):
+        body = body.encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+def load_prepared(path, record_key = None, use_existing_ons_id = True):
+    """
+    Loads microdata for the service. A directory saved with
+    PreparedMicrodata.save() is opened directly; an Arrow / Feather file, a
+    directory of .npy columns or a CSV file is read and prepared.
+
+    Parameters
+    ----------
+    path : str
+        Location of the microdata.
+    record_key : str
+        Name of the record key column, when the data are not prepared yet.
+    use_existing_ons_id : Boolean
+        Whether to create record keys from ons_id, if ons_id exists in data.
+
+    Returns
+    -------
+    PreparedMicrodata
+    """
+    if os.path.isfile(os.path.join(path, "metadata.json")):
+        return PreparedMicrodata.load(path)
+    if path.endswith(".csv"):
+        data = pd.read_csv(path)
+    else:
+        source = ColumnarSource(path)
+        data = source.read(source.columns)
+    return PreparedMicrodata.from_dataframe(data,
+                                            record_key = record_key,
+                                            use_existing_ons_id = use_existing_ons_id)
+
+
+def main(argv = None):
+    parser = argparse.ArgumentParser(
+        description="Serve cell key perturbed tables from microdata loaded once.")
+    parser.add_argument("--data", required=True,
+                        help="Prepared microdata directory, Arrow/Feather file, "
+                             ".npy column directory or CSV file.")
+    parser.add_argument("--ptable", required=True, help="ptable CSV file.")
+    parser.add_argument("--record-key", default=None,
+                        help="Record key column, if the data are not prepared.")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8080)
+    parser.add_argument("--socket", default=None,
+                        help="Listen on this Unix socket instead of host and port.")
+    parser.add_argument("--max-cells", type=int, default=1_000_000)
+    parser.add_argument("--max-concurrent", type=int, default=4)
+    parser.add_argument("--min-threshold", type=int, default=10)
+    args = parser.parse_args(argv)
+
+    prepared = load_prepared(args.data, record_key = args.record_key)
+    builder = TableBuilder(prepared,
+                           pd.read_csv(args.ptable),
+                           max_cells = args.max_cells,
+                           min_threshold = args.min_threshold)
+    server = create_server(builder,
+                           host = args.host,
+                           port = args.port,
+                           socket_path = args.socket,
+                           max_concurrent = args.max_concurrent)
+
+    print(f"Serving {len(prepared)} records on "
+          f"{args.socket or f'{args.host}:{args.port}'}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,211 @@
+import pandas as pd
+
+from cell_key_perturbation.utils.validate_inputs_before_perturbation import validate_inputs_spark
+
+def create_perturbed_table_spark(data,
+                                 ptable,
+                                 geog,
+                                 tab_vars,
+                                 record_key,
+                                 use_existing_ons_id = True,
+                                 threshold = 10
+                                 ):
+    """
+    Function creates a frequency table which has has a cell key perturbation
+    technique applied with help from a p-table.
+    This function runs the method in Spark with DataFrame operations, so the
+    microdata are never collected to the driver. The aggregation is spread
+    across the executors, and only the categories of each variable and the
+    ptable are small enough to be shared with every executor.
+
+    This function applies the following steps:
+        1) Validate inputs
+        2) Build the frequency table from micro data
+        3) Complete the grid with zero-count cells
+        4) Merge the frequency table with perturbation table
+        5) Apply perturbation and suppression
+
+    Given the same microdata, the result is identical to
+    create_perturbed_table(), apart from any extra ptable columns, which are
+    not included. Use collect_perturbed_table() to bring it into pandas with
+    the same column types. The table is computed and persisted in Spark
+    before it is returned, so it can be collected or written several times
+    without aggregating the microdata again; release it with
+    perturbed_table.unpersist() when it is no longer needed.
+
+    Parameters:
+    ----------
+    data : pyspark.sql.DataFrame
+        The microdata, with one row per statistical unit (person, household,
+        business or other) and one column per variable (e.g. age, sex,
+        health status)
+    ptable : pyspark.sql.DataFrame or pandas.DataFrame
+        A data frame containing the 'ptable' file.
+    geog : list of str
+        A vector with one entry, the column name in 'data' that contains the
+        desired geography level for the frequency table.
+        For example ["Region"], ["Local Authority"]. If no geography
+        breakdown is needed, this should be an empty vector: []
+    tab_vars : list of str
+        A vector containing the column names in 'data' of the variables to be
+        tabulated. For example ["Age","Health","Occupation"]
+    record_key : str
+        The column name in 'data' that contains the record keys required for
+        perturbation. For example: "Record_Key"
+        If data contains "ons_id" and use_existing_ons_id = True,
+        set (record_key = None), as record key will be generated from "ons_id".
+    use_existing_ons_id : Boolean
+        Whether to create record keys from ons_id, if ons_id exists in data.
+        It will be irrelevant if microdata does not contain ons_id.
+        Default is True.
+    threshold : integer
+        Suppression threshold; cells with perturbed counts below this value
+        will be suppressed (set to null).
+        Default is 10.
+
+    Returns:
+    -------
+    perturbed_table : pyspark.sql.DataFrame
+        A frequency table which has had cell key perturbation and a suppression
+        threshold applied, sorted by geog and tab_vars. It is persisted, and
+        can be released with perturbed_table.unpersist().
+
+    Examples
+    --------
+    >>> spark = SparkSession.builder.master("local[*]").getOrCreate()
+    >>> micro_spark = spark.createDataFrame(micro)
+    >>> perturbed_table = create_perturbed_table_spark(data = micro_spark,
+    ...                                                ptable = ptable_10_5,
+    ...                                                geog = ["var1"],
+    ...                                                tab_vars = ["var5","var8"],
+    ...                                                record_key = "record_key")
+    >>> collect_perturbed_table(perturbed_table)
+    >>> perturbed_table.unpersist()
+    """
+    SparkDataFrame, F = _import_pyspark()
+
+    if not isinstance(data, SparkDataFrame):
+        raise TypeError("Specified value for data must be a Spark DataFrame.")
+    if isinstance(ptable, pd.DataFrame):
+        ptable = data.sparkSession.createDataFrame(ptable)
+
+    #%%# Generate record keys from "ons_id" if exists
+    if use_existing_ons_id & ("ons_id" in data.columns):
+        print('NOTE: "ons_id" column is available in data!',
+              'Generating record keys from "ons_id"!')
+
+        data = data.withColumn(
+            "ons_record_key",
+            F.pmod(F.expr("try_cast(ons_id AS BIGINT)"), F.lit(4096))
+            )
+        record_key = "ons_record_key"
+
+    # Spark keeps NaN apart from null, whereas pandas treats both as missing
+    if record_key in data.columns and dict(data.dtypes)[record_key] in ("float", "double"):
+        data = data.withColumn(record_key,
+                               F.nanvl(F.col(record_key), F.lit(None).cast("double")))
+
+    #%%# Step 0: Validate Inputs
+    validate_inputs_spark(data, ptable, geog, tab_vars, record_key, threshold)
+
+    all_vars = geog + tab_vars
+
+    #%%# Step 1: Aggregate counts and record key sums across the executors
+    # As in pandas, records with a missing category are not tabulated and
+    # missing record keys add nothing to the sum
+    base_counts = (
+        data.dropna(subset = all_vars)
+            .groupBy(*all_vars)
+            .agg(F.count(F.lit(1)).alias("pre_sdc_count"),
+                 F.sum(F.col(record_key).cast("long")).alias("sum_rkey"))
+            .persist()
+    )
+
+    #%%# Step 2: Create the full grid from the categories of each variable
+    # The aggregated counts are persisted above, so the microdata are only
+    # aggregated once, although they are used for every variable and the join
+    full_grid = None
+    for v in all_vars:
+        dim = base_counts.select(v).distinct()
+        full_grid = dim if full_grid is None else full_grid.crossJoin(dim)
+
+    full_counts = (
+        full_grid.join(base_counts, on = all_vars, how = "left")
+                 .fillna(0, subset = ["pre_sdc_count", "sum_rkey"])
+    )
+
+    #%%# Step 3: Compute cell keys and pcv
+    modulus = ptable.agg(F.max("ckey")).first()[0] + 1
+
+    pre_sdc_count = F.col("pre_sdc_count")
+    full_counts = (
+        full_counts
+            .withColumn("ckey", F.pmod(F.col("sum_rkey"), F.lit(modulus)))
+            .withColumn("pcv",
+                        F.when(pre_sdc_count <= 750, pre_sdc_count)
+                         .otherwise(F.pmod(pre_sdc_count - 1, F.lit(250)) + 501))
+            .drop("sum_rkey")
+    )
+
+    #%%# Step 4: Join with the ptable, which is sent to every executor
+    pvalues = ptable.select(F.col("pcv").cast("long"),
+                            F.col("ckey").cast("long"),
+                            F.col("pvalue").cast("long"))
+    joined = (
+        full_counts.join(F.broadcast(pvalues), on = ["pcv", "ckey"], how = "left")
+                   .fillna(0, subset = ["pvalue"])
+    )
+
+    #%%# Step 5: Apply perturbation and suppression
+    perturbed_count = F.col("pre_sdc_count") + F.col("pvalue")
+    perturbed_table = joined.withColumn(
+        "count",
+        F.when(perturbed_count < threshold, F.lit(None).cast("long"))
+         .otherwise(perturbed_count)
+        )
+
+    perturbed_table = (
+        perturbed_table.select(*all_vars, "pre_sdc_count", "ckey", "pcv",
+                               "pvalue", "count")
+                       .orderBy(*all_vars)
+                       .persist()
+    )
+
+    # Once the table is materialised the aggregated counts are no longer
+    # needed, so only the table is left in the cache
+    perturbed_table.count()
+    base_counts.unpersist()
+
+    return perturbed_table
+
+
+def collect_perturbed_table(perturbed_table):
+    """
+    Collects a perturbed table created in Spark into a pandas data frame,
+    with the same column types as the output of create_perturbed_table().
+
+    Parameters:
+    ----------
+    perturbed_table : pyspark.sql.DataFrame
+        Output of create_perturbed_table_spark().
+
+    Returns:
+    -------
+    perturbed_table : pandas.DataFrame
+    """
+    perturbed_table = perturbed_table.toPandas()
+
+    for col in ["pre_sdc_count", "ckey", "pcv", "pvalue"]:
+        perturbed_table[col] = perturbed_table[col].astype("int64")
+    perturbed_table["count"] = perturbed_table["count"].astype("Int64")
+
+    return perturbed_table
+
+
+def _import_pyspark():
+    try:
+        from pyspark.sql import DataFrame, functions
+    except ImportError as e:
+        raise ImportError("pyspark is required to run the method in Spark. "
+                          "Install it with: pip install pyspark") from e
+    return DataFrame, functions
@@ -0,0 +1,162 @@
+import numpy as np
+import pandas as pd
+
+from cell_key_perturbation.utils.perturbation_pandas import (
+    aggregate_microdata, complete_grid, compile_ptable, calculate_pcv,
+    lookup_pvalue, suppress
+)
+from cell_key_perturbation.utils.validate_inputs_before_perturbation import validate_inputs
+from cell_key_perturbation.utils.generate_record_key import generate_record_key_from_ons_id
+from cell_key_perturbation.columnar_source import ColumnarSource, read_required_columns
+
+def sweep_perturbation_parameters(data,
+                                  ptables,
+                                  thresholds,
+                                  geog,
+                                  tab_vars,
+                                  record_key,
+                                  use_existing_ons_id = True,
+                                  return_tables = True
+                                  ):
+    """
+    Function compares several ptables and thresholds on the same frequency
+    table, aggregating the microdata only once.
+
+    The full grid of counts and record key sums is created once. For each
+    ptable, the cell keys and perturbation values are then calculated for
+    the whole grid at once, and each threshold is applied to the perturbed
+    counts. Each table is identical to the output of create_perturbed_table()
+    with the same ptable and threshold, apart from any extra ptable columns.
+
+    Parameters
+    ----------
+    data : Pandas data frame
+    A pandas data frame containing the data to be tabulated and perturbed,
+    or a ColumnarSource.
+
+    ptables: Dictionary
+    The ptables to compare, as pandas data frames keyed by a name for each.
+    A list of ptables can also be given, which are named by their position.
+
+    thresholds: Vector
+    The thresholds to compare, as integers. For example [0, 10, 20].
+
+    geog : Vector
+    A vector with one entry, the column name in 'data' that contains the
+    desired geography level for the frequency table, or an empty vector: []
+
+    tab_vars: Vector
+    A vector containing the column names in 'data' of the variables to be
+    tabulated.
+
+    record_key: String
+    The column name in 'data' that contains the record keys required for
+    perturbation. Set (record_key = None) if record keys will be generated
+    from "ons_id".
+
+    use_existing_ons_id: Boolean
+    Whether to create record keys from ons_id, if ons_id exists in data.
+    Default is True.
+
+    return_tables: Boolean
+    Whether to return the perturbed tables, or only the summary.
+    Default is True.
+
+    Returns
+    -------
+    perturbed_tables: Dictionary
+    A perturbed frequency table for each combination of ptable and threshold,
+    keyed by (ptable name, threshold). Empty if return_tables = False.
+
+    summary: Pandas data frame
+    One row per combination of ptable and threshold, with columns:
+        - ptable, threshold
+        - cells: number of cells in the table
+        - cells_changed: number of cells with a non-zero perturbation value
+        - cells_suppressed: number of non-empty cells suppressed
+        - total_abs_deviation: sum of the absolute differences between the
+        published and pre-perturbation counts, over cells not suppressed
+        - mean_abs_deviation: total_abs_deviation divided by the number of
+        cells not suppressed
+
+    Examples
+    --------
+    >>> perturbed_tables, summary = sweep_perturbation_parameters(
+    ...     data = micro,
+    ...     ptables = {"10_5": ptable_10_5, "census": ptable_census21},
+    ...     thresholds = [0, 10, 20],
+    ...     geog = ["var1"],
+    ...     tab_vars = ["var5","var8"],
+    ...     record_key = "record_key")
+
+    >>> perturbed_tables[("census", 10)]
+    """
+    if not isinstance(ptables, dict):
+        ptables = dict(enumerate(ptables))
+    if len(ptables) == 0 or len(thresholds) == 0:
+        raise Exception("At least one ptable and one threshold must be given.")
+
+    #%%# Read only the required columns from a columnar source
+    if isinstance(data, ColumnarSource):
+        data = read_required_columns(data, geog, tab_vars, record_key,
+                                     use_existing_ons_id)
+
+    #%%# Generate record keys from "ons_id" if exists
+    if use_existing_ons_id & ("ons_id" in data.columns):
+        print('NOTE: "ons_id" column is available in data!',
+              'Generating record keys from "ons_id"!')
+
+        data = generate_record_key_from_ons_id(data,
+                                               record_key_col="ons_record_key")
+        record_key = "ons_record_key"
+
+    #%%# Step 0: Validate Inputs
+    for threshold in thresholds:
+        if not isinstance(threshold, int):
+            raise Exception("Specified values for thresholds must be integers.")
+    for ptable in ptables.values():
+        validate_inputs(data, ptable, geog, tab_vars, record_key, thresholds[0])
+
+    #%%# Step 1: Create the full grid of counts and record key sums once
+    grid = complete_grid(aggregate_microdata(data, geog, tab_vars, record_key),
+                         geog + tab_vars)
+    pre_sdc_count = grid["pre_sdc_count"].to_numpy()
+    sum_rkey = grid["sum_rkey"].to_numpy()
+    pcv = calculate_pcv(pre_sdc_count)
+    grid = grid[geog + tab_vars]
+
+    #%%# Step 2: Apply each ptable and threshold to the whole grid
+    perturbed_tables = {}
+    summary = []
+    for name, ptable in ptables.items():
+        pvalues = compile_ptable(ptable)
+        ckey = (sum_rkey % pvalues.shape[1]).astype(int)
+        pvalue = lookup_pvalue(pvalues, pcv, ckey)
+        perturbed_count = pre_sdc_count + pvalue
+        deviation = np.abs(pvalue)
+
+        for threshold in thresholds:
+            suppressed = perturbed_count < threshold
+            published = ~suppressed
+            total_abs_deviation = int(deviation[published].sum())
+            summary.append({
+                "ptable": name,
+                "threshold": threshold,
+                "cells": len(pre_sdc_count),
+                "cells_changed": int((pvalue != 0).sum()),
+                "cells_suppressed": int((suppressed & (pre_sdc_count > 0)).sum()),
+                "total_abs_deviation": total_abs_deviation,
+                "mean_abs_deviation": (total_abs_deviation / published.sum()
+                                       if published.any() else np.nan)
+            })
+
+            if return_tables:
+                table = grid.copy()
+                table["pre_sdc_count"] = pre_sdc_count
+                table["ckey"] = ckey
+                table["pcv"] = pcv
+                table["pvalue"] = pvalue
+                table["count"] = suppress(perturbed_count, threshold)
+                perturbed_tables[(name, threshold)] = table
+
+    return perturbed_tables, pd.DataFrame(summary)
@@ -0,0 +1,437 @@
+"""
+Checks that the engines implementing cell key perturbation agree, and
+compares how fast they are.
+
+The BigQuery engine is stood in for by SQLite: the query built by
+build_perturbation_bigquery() is translated to SQLite and run on an
+in-memory copy of the data, so the SQL text itself is checked without a
+BigQuery project.
+
+Examples
+--------
+>>> summary = run_regression_harness(sizes = [10_000, 1_000_000],
+...                                  engines = ["pandas", "sql", "numpy"])
+"""
+
+import contextlib
+import io
+import re
+import sqlite3
+import time
+
+import numpy as np
+import pandas as pd
+
+from cell_key_perturbation.create_perturbed_table import create_perturbed_table
+from cell_key_perturbation.utils.perturbation_bigquery import build_perturbation_bigquery
+from cell_key_perturbation.utils.generate_record_key import record_key_sql_expression
+from cell_key_perturbation.utils.generate_test_data import generate_test_data
+from cell_key_perturbation.utils.generate_test_ptable import generate_ptable_10_5_rule
+
+COMPARED_COLUMNS = ["pre_sdc_count", "ckey", "pcv", "pvalue", "count"]
+
+DEFAULT_TABLES = [(["var1"], ["var5", "var8"]),
+                  ([], ["var2", "var3", "var4"]),
+                  (["var10"], ["var9"])]
+
+
+def load_sqlite(data, ptable):
+    """
+    Copies the microdata and ptable into a new in-memory SQLite database,
+    as the tables "microdata" and "ptable", with the BigQuery functions used
+    by the perturbation query registered.
+
+    Parameters:
+    ----------
+    data : pandas.DataFrame
+        The microdata.
+    ptable : pandas.DataFrame
+        The ptable.
+
+    Returns:
+    -------
+    connection : sqlite3.Connection
+    """
+    connection = sqlite3.connect(":memory:")
+    connection.create_function("MOD", 2, _bigquery_mod, deterministic=True)
+    connection.create_function("SAFE_CAST_INT64", 1, _bigquery_safe_cast_int64,
+                               deterministic=True)
+    try:
+        data.to_sql("microdata", connection, index=False)
+        ptable.to_sql("ptable", connection, index=False)
+    except BaseException:
+        connection.close()
+        raise
+    return connection
+
+
+def run_perturbation_sql(data,
+                         ptable,
+                         geog,
+                         tab_vars,
+                         record_key,
+                         use_existing_ons_id = True,
+                         threshold = 10,
+                         connection = None):
+    """
+    Runs the BigQuery perturbation query on pandas data frames, using an
+    in-memory SQLite database in place of BigQuery.
+
+    Parameters:
+    ----------
+    Same as for create_perturbed_table(), with data and ptable as pandas
+    data frames, plus:
+    connection : sqlite3.Connection, optional
+        A database returned by load_sqlite() for the same data and ptable,
+        so the query can be run several times without copying them again.
+        Default is None, which copies them into a new database that is
+        closed afterwards.
+
+    Returns:
+    -------
+    perturbed_table : pandas.DataFrame
+        The query result, sorted by geog and tab_vars.
+    """
+    own_connection = connection is None
+    if own_connection:
+        connection = load_sqlite(data, ptable)
+    try:
+        query = build_perturbation_bigquery(data = "microdata",
+                                            ptable = "ptable",
+                                            geog = geog,
+                                            tab_vars = tab_vars,
+                                            record_key = record_key,
+                                            threshold = threshold)
+
+        # As in create_perturbed_table_bigquery()
+        if use_existing_ons_id & ("ons_id" in data.columns):
+            query = query.replace(f"SAFE_CAST({record_key} AS INT64)",
+                                  record_key_sql_expression())
+
+        perturbed_table = pd.read_sql_query(translate_bigquery_to_sqlite(query),
+                                            connection)
+    finally:
+        if own_connection:
+            connection.close()
+
+    return perturbed_table.sort_values(geog + tab_vars).reset_index(drop=True)
+
+
+def run_perturbation_spark(data,
+                           ptable,
+                           geog,
+                           tab_vars,
+                           record_key,
+                           use_existing_ons_id = True,
+                           threshold = 10):
+    """
+    Runs create_perturbed_table_spark() on pandas data frames, in the active
+    SparkSession or, if there is none, a new local one.
+
+    Parameters:
+    ----------
+    Same as for create_perturbed_table(), with data and ptable as pandas
+    data frames.
+
+    Returns:
+    -------
+    perturbed_table : pandas.DataFrame
+        The perturbed table, collected with collect_perturbed_table().
+    """
+    from pyspark.sql import SparkSession
+    from cell_key_perturbation.spark import create_perturbed_table_spark, collect_perturbed_table
+
+    spark = SparkSession.getActiveSession()
+    if spark is None:
+        spark = SparkSession.builder.master("local[*]").getOrCreate()
+
+    perturbed_table = create_perturbed_table_spark(data = spark.createDataFrame(data),
+                                                   ptable = ptable,
+                                                   geog = geog,
+                                                   tab_vars = tab_vars,
+                                                   record_key = record_key,
+                                                   use_existing_ons_id = use_existing_ons_id,
+                                                   threshold = threshold)
+    try:
+        return collect_perturbed_table(perturbed_table)
+    finally:
+        perturbed_table.unpersist()
+
+
+def translate_bigquery_to_sqlite(query):
+    """
+    Rewrites the BigQuery functions used by the perturbation queries into
+    functions registered by load_sqlite(). Backtick quoted table
+    names are already understood by SQLite.
+    """
+    return re.sub(r"SAFE_CAST\(([^()]*?) AS INT64\)", r"SAFE_CAST_INT64(\1)", query)
+
+
+def compare_tables(reference, table, variables):
+    """
+    Compares two perturbed tables cell by cell.
+
+    Parameters:
+    ----------
+    reference : pandas.DataFrame
+        The expected table.
+    table : pandas.DataFrame
+        The table to check.
+    variables : list of str
+        geog + tab_vars, identifying the cells.
+
+    Returns:
+    -------
+    mismatches : pandas.DataFrame
+        The cells that differ in the variables or in any of 'pre_sdc_count',
+        'ckey', 'pcv', 'pvalue' and 'count', with the values of both tables.
+        Empty if the tables are identical.
+    """
+    reference = reference.sort_values(variables).reset_index(drop=True)
+    table = table.sort_values(variables).reset_index(drop=True)
+
+    n_cells = max(len(reference), len(table))
+    reference = reference.reindex(range(n_cells))
+    table = table.reindex(range(n_cells))
+
+    differs = np.zeros(n_cells, dtype=bool)
+    for col in variables:
+        differs |= ~_equal_values(reference[col], table[col])
+    for col in COMPARED_COLUMNS:
+        differs |= ~_equal_values(reference[col].astype("Int64"),
+                                  table[col].astype("Int64"))
+
+    return pd.concat([reference.loc[differs, variables + COMPARED_COLUMNS],
+                      table.loc[differs, variables + COMPARED_COLUMNS]],
+                     axis=1, keys=["reference", "table"])
+
+
+def compare_engines(data,
+                    ptable,
+                    geog,
+                    tab_vars,
+                    record_key,
+                    use_existing_ons_id = True,
+                    threshold = 10,
+                    engines = ("pandas", "sql"),
+                    repeat = 1,
+                    raise_on_mismatch = True):
+    """
+    Creates the same perturbed table with several engines, checks that they
+    agree with the first engine cell by cell, and records their runtimes.
+
+    Parameters:
+    ----------
+    data, ptable, geog, tab_vars, record_key, use_existing_ons_id, threshold
+        Same as for create_perturbed_table().
+    engines : list or dict
+        Engines to compare, the first being the reference. Either names of
+        built-in engines: "pandas", "numpy" and "numba" (create_perturbed_table()
+        with that engine), "sql" (run_perturbation_sql() on data loaded once
+        with load_sqlite()) and "spark" (run_perturbation_spark(), requires
+        pyspark and Java), or a dictionary of functions keyed by name, taking
+        the same arguments as create_perturbed_table() and returning a pandas
+        data frame. A function may also have load(data, ptable) and close()
+        methods, called before and after its runs, so that copying the inputs
+        into the engine is not included in its runtime.
+        Default is ("pandas", "sql").
+    repeat : integer
+        Number of times each engine is run. The fastest run is reported, so
+        repeat > 1 leaves out one-off costs such as numba compilation.
+        Default is 1.
+    raise_on_mismatch : Boolean
+        Whether to raise an exception if any engine disagrees with the
+        reference. Default is True.
+
+    Returns:
+    -------
+    summary : pandas.DataFrame
+        One row per engine, with the number of cells, the number of cells
+        that differ from the reference, the time taken to load the inputs
+        into the engine (0 for engines that use the data frames directly),
+        the runtime in seconds and the speed-up of the runtime relative to
+        the reference.
+    """
+    engines = _resolve_engines(engines)
+    variables = geog + tab_vars
+
+    summary = []
+    reference = None
+    for name, engine in engines.items():
+        # Copying the inputs into an engine is timed apart from the runs
+        load_seconds = 0.0
+        if hasattr(engine, "load"):
+            start = time.perf_counter()
+            engine.load(data, ptable)
+            load_seconds = time.perf_counter() - start
+
+        seconds = []
+        try:
+            for _ in range(repeat):
+                start = time.perf_counter()
+                # The engines print notes and warnings on every run
+                with contextlib.redirect_stdout(io.StringIO()):
+                    table = engine(data = data,
+                                   ptable = ptable,
+                                   geog = geog,
+                                   tab_vars = tab_vars,
+                                   record_key = record_key,
+                                   use_existing_ons_id = use_existing_ons_id,
+                                   threshold = threshold)
+                seconds.append(time.perf_counter() - start)
+        finally:
+            if hasattr(engine, "close"):
+                engine.close()
+
+        if reference is None:
+            reference = table
+        mismatches = compare_tables(reference, table, variables)
+
+        if raise_on_mismatch and len(mismatches):
+            raise Exception(f"Engine '{name}' differs from '{list(engines)[0]}' "
+                            f"in {len(mismatches)} cell(s):\n{mismatches.head()}")
+
+        summary.append({"engine": name,
+                        "cells": len(table),
+                        "mismatched_cells": len(mismatches),
+                        "load_seconds": load_seconds,
+                        "seconds": min(seconds)})
+
+    summary = pd.DataFrame(summary)
+    summary["speedup"] = summary["seconds"].iloc[0] / summary["seconds"]
+    return summary
+
+
+def run_regression_harness(sizes = (10_000, 100_000),
+                           tables = None,
+                           ptable = None,
+                           engines = ("pandas", "sql"),
+                           threshold = 10,
+                           repeat = 1,
+                           raise_on_mismatch = True):
+    """
+    Compares engines on generated microdata of several sizes and several
+    table specifications.
+
+    Parameters:
+    ----------
+    sizes : list of int
+        Numbers of records of the generated microdata.
+        Default is (10_000, 100_000).
+    tables : list of (geog, tab_vars) pairs
+        Tables to create, with variables of generate_test_data().
+        Default is DEFAULT_TABLES.
+    ptable : pandas.DataFrame
+        The ptable. Default is generate_ptable_10_5_rule().
+    engines, threshold, repeat, raise_on_mismatch
+        Same as for compare_engines().
+
+    Returns:
+    -------
+    summary : pandas.DataFrame
+        The summaries of compare_engines(), with the size and table of each.
+    """
+    if tables is None:
+        tables = DEFAULT_TABLES
+    if ptable is None:
+        ptable = generate_ptable_10_5_rule()
+
+    summaries = []
+    for size in sizes:
+        data = generate_test_data(size = size)
+        for geog, tab_vars in tables:
+            summary = compare_engines(data = data,
+                                      ptable = ptable,
+                                      geog = geog,
+                                      tab_vars = tab_vars,
+                                      record_key = "record_key",
+                                      threshold = threshold,
+                                      engines = engines,
+                                      repeat = repeat,
+                                      raise_on_mismatch = raise_on_mismatch)
+            summary.insert(0, "size", size)
+            summary.insert(1, "table", ", ".join(geog + tab_vars))
+            summaries.append(summary)
+
+    return pd.concat(summaries, ignore_index=True)
+
+
+def _resolve_engines(engines):
+    """
+    Maps names of built-in engines to functions.
+    """
+    if isinstance(engines, dict):
+        return engines
+
+    resolved = {}
+    for name in engines:
+        if name == "sql":
+            resolved[name] = _SqliteEngine()
+        elif name == "spark":
+            resolved[name] = run_perturbation_spark
+        elif name in ("pandas", "numpy", "numba"):
+            resolved[name] = _create_with_engine(name)
+        else:
+            raise Exception(f"Unknown engine '{name}'. "
+                            "Expected 'pandas', 'numpy', 'numba', 'sql' or 'spark'.")
+    return resolved
+
+
+class _SqliteEngine:
+    """
+    Runs the BigQuery perturbation query in SQLite, on data loaded once
+    before the timed runs.
+    """
+    def __init__(self):
+        self.connection = None
+
+    def load(self, data, ptable):
+        self.connection = load_sqlite(data, ptable)
+
+    def close(self):
+        if self.connection is not None:
+            self.connection.close()
+            self.connection = None
+
+    def __call__(self, **arguments):
+        return run_perturbation_sql(connection = self.connection, **arguments)
+
+
+def _create_with_engine(engine):
+    def create(**arguments):
+        return create_perturbed_table(engine = engine, **arguments)
+    return create
+
+
+def _equal_values(a, b):
+    """
+    Element-wise equality, with missing values equal to each other.
+    """
+    both_missing = (a.isna() & b.isna()).to_numpy(dtype=bool)
+    equal = a.eq(b).fillna(False).to_numpy(dtype=bool)
+    return equal | both_missing
+
+
+def _bigquery_mod(x, y):
+    """
+    MOD as in BigQuery, where the result has the sign of x.
+    """
+    if x is None or y is None:
+        return None
+    result = abs(x) % abs(y)
+    return -result if x < 0 else result
+
+
+def _bigquery_safe_cast_int64(value):
+    """
+    SAFE_CAST(value AS INT64) as in BigQuery, returning NULL for values that
+    are not integers.
+    """
+    if value is None:
+        return None
+    if isinstance(value, float):
+        return int(round(value)) if np.isfinite(value) else None
+    try:
+        return int(str(value).strip())
+    except ValueError:
+        return None
@@ -1,35 +1,192 @@
+import hashlib
 
 import numpy as np
 import pandas as pd
 
+# Record keys derived from ons_id are in the range 0-4095
+ONS_ID_KEY_RANGE = 4096
 
-def generate_record_key_from_ons_id(data, record_key_col):
+
+def generate_record_key_from_ons_id(data, 
+                                    record_key_col, 
+                                    hash_non_numeric = False, 
+                                    return_stats = False):
     """
     Function to generate record key from ons_id by taking modulo 4096.
 
     - Converts 'ons_id' to numeric by allowing null values.
     - Uses pandas nullable integer dtype ('Int64') to keep missing values.
+    - IDs made of digits only are parsed directly from Arrow string buffers 
+    when pyarrow is installed, which is much faster than pd.to_numeric() on 
+    object columns. Other IDs are converted with pd.to_numeric().
+    - IDs that are not numeric get a missing record key, unless 
+    hash_non_numeric = True, in which case their key is taken from a 
+    SHA-256 hash of the ID. The same keys are given by 
+    record_key_sql_expression() in BigQuery.
     
     Parameters:
     -----------
     data : pandas.DataFrame
         Microdata with ons_id to calculate record keys
+    record_key_col : str
+        Name of the record key column to add.
+    hash_non_numeric : Boolean
+        Whether to derive record keys for non-numeric IDs by hashing them.
+        Default is False.
+    return_stats : Boolean
+        Whether to also return the statistics of the derivation.
+        Default is False.
 
     Returns
     -------
     df: pd.DataFrame
         DataFrame with 'ons_record_key' added
+    stats: dict
+        Only if return_stats = True. Numbers of IDs that were 'missing', 
+        'numeric', 'hashed' and 'rejected' (non-numeric IDs given no key).
     """
     if not isinstance(data, pd.DataFrame):
         raise TypeError("data must be a pandas DataFrame")
     
     df = data.copy()
-    ons_id_numeric = pd.to_numeric(df["ons_id"], errors="coerce")
-    df[record_key_col] = (ons_id_numeric % 4096).astype("Int64")
+    record_keys, stats = derive_record_keys(df["ons_id"], 
+                                            hash_non_numeric = hash_non_numeric)
+    df[record_key_col] = record_keys
+    
+    if stats["rejected"] > 0:
+        print(f"Warning: {stats['rejected']} ons_id value(s) are not numeric "
+              "and have missing record keys.")
 
+    if return_stats:
+        return df, stats
     return df
 
 
+def derive_record_keys(ons_id, hash_non_numeric = False):
+    """
+    Derives record keys in the range 0-4095 from a column of IDs.
+    
+    Parameters:
+    -----------
+    ons_id : pandas.Series
+        The IDs, as strings or numbers.
+    hash_non_numeric : Boolean
+        Whether to derive record keys for non-numeric IDs by hashing them.
+        Default is False.
+
+    Returns
+    -------
+    record_keys : pandas.Series
+        Record keys with nullable integer dtype ('Int64').
+    stats : dict
+        Numbers of IDs that were 'missing', 'numeric', 'hashed' and 
+        'rejected'.
+    """
+    missing = ons_id.isna().to_numpy()
+    
+    if pd.api.types.is_numeric_dtype(ons_id):
+        record_keys = (ons_id % ONS_ID_KEY_RANGE).astype("Int64")
+    else:
+        record_keys = _keys_from_string_ids(ons_id)
+    
+    non_numeric = record_keys.isna().to_numpy() & ~missing
+    
+    n_hashed = 0
+    if hash_non_numeric and non_numeric.any():
+        record_keys[non_numeric] = _hash_ids(ons_id[non_numeric])
+        n_hashed = int(non_numeric.sum())
+    
+    stats = {"missing": int(missing.sum()),
+             "numeric": int((~missing & ~non_numeric).sum()),
+             "hashed": n_hashed,
+             "rejected": int(non_numeric.sum()) - n_hashed}
+    
+    return record_keys, stats
+
+
+def record_key_sql_expression(column = "ons_id", hash_non_numeric = False):
+    """
+    Returns a BigQuery SQL expression deriving record keys from a column of 
+    IDs, giving the same keys as generate_record_key_from_ons_id() for IDs 
+    made of digits only.
+    
+    Parameters:
+    -----------
+    column : str
+        Name of the ID column. Default is "ons_id".
+    hash_non_numeric : Boolean
+        Whether to derive record keys for non-numeric IDs by hashing them, 
+        as generate_record_key_from_ons_id() does. Default is False.
+
+    Returns
+    -------
+    str
+        The SQL expression.
+    """
+    # MOD keeps the sign in BigQuery, so shift negative IDs into range as pandas does
+    numeric_key = (f"MOD(MOD(SAFE_CAST({column} AS INT64), {ONS_ID_KEY_RANGE})"
+                   f" + {ONS_ID_KEY_RANGE}, {ONS_ID_KEY_RANGE})")
+    if not hash_non_numeric:
+        return numeric_key
+    
+    hashed_key = (f"MOD(CAST(CONCAT('0x', SUBSTR(TO_HEX(SHA256(CAST({column} AS STRING)))"
+                  f", 1, 8)) AS INT64), {ONS_ID_KEY_RANGE})")
+    return (f"CASE WHEN {column} IS NULL THEN NULL "
+            f"ELSE COALESCE({numeric_key}, {hashed_key}) END")
+
+
+def _keys_from_string_ids(ons_id):
+    """
+    Record keys from IDs held as strings, with missing keys for IDs that are 
+    not numeric. IDs made of digits only are parsed by pyarrow; anything else 
+    is left to pd.to_numeric(), as before.
+    """
+    try:
+        import pyarrow as pa
+        import pyarrow.compute as pc
+    except ImportError:
+        return (pd.to_numeric(ons_id, errors="coerce") % ONS_ID_KEY_RANGE).astype("Int64")
+    
+    try:
+        ids = pa.array(ons_id, type=pa.string(), from_pandas=True)
+    except (pa.ArrowInvalid, pa.ArrowTypeError):
+        # Strings mixed with numbers
+        return (pd.to_numeric(ons_id, errors="coerce") % ONS_ID_KEY_RANGE).astype("Int64")
+    
+    try:
+        # Usually every ID is a plain integer, and one cast is enough
+        parsed = pc.cast(ids, pa.int64())
+        remaining = np.zeros(len(ids), dtype=bool)
+    except pa.ArrowInvalid:
+        is_integer = pc.fill_null(pc.match_substring_regex(ids, r"^-?[0-9]{1,18}$"), False)
+        parsed = pc.cast(pc.if_else(is_integer, ids, None), pa.int64())
+        remaining = ~is_integer.to_numpy(zero_copy_only=False) & ~ons_id.isna().to_numpy()
+    
+    record_keys = pd.Series(
+        pd.arrays.IntegerArray(
+            np.mod(pc.fill_null(parsed, 0).to_numpy(zero_copy_only=False), ONS_ID_KEY_RANGE),
+            ~parsed.is_valid().to_numpy(zero_copy_only=False)
+            ),
+        index=ons_id.index
+        )
+    
+    if remaining.any():
+        record_keys[remaining] = (
+            pd.to_numeric(ons_id[remaining], errors="coerce") % ONS_ID_KEY_RANGE
+            ).astype("Int64")
+    
+    return record_keys
+
+
+def _hash_ids(ons_id):
+    """
+    Record keys from the first 4 bytes of the SHA-256 hash of each ID, as 
+    in record_key_sql_expression().
+    """
+    return np.array([int.from_bytes(hashlib.sha256(str(i).encode()).digest()[:4], "big")
+                     % ONS_ID_KEY_RANGE for i in ons_id], dtype="int64")
+
+
 def generate_random_rkey(data, key_range = 255):
     """
     Function to create and attach random record keys to microdata
@@ -0,0 +1,191 @@
+"""
+Fused aggregation and perturbation of dictionary-encoded microdata.
+
+Each record's category codes are mapped to a cell of the full grid, counts
+and record key sums are accumulated for every cell, and the ptable lookup and
+threshold are applied, without creating any intermediate data frames. When
+numba is installed the work is done by a compiled kernel running in parallel;
+otherwise an equivalent NumPy implementation is used.
+"""
+
+import importlib.util
+
+import numpy as np
+import pandas as pd
+
+from cell_key_perturbation.utils.perturbation_pandas import (
+    dense_grid_frame, compile_ptable, calculate_pcv, lookup_pvalue
+)
+
+# numba is only imported when the kernel is used, as it is slow to load
+HAS_NUMBA = importlib.util.find_spec("numba") is not None
+
+# Limit on the per-thread accumulators of the numba kernel, in grid cells
+_MAX_ACCUMULATOR_CELLS = 2 ** 23
+
+
+def encode_columns(data, variables):
+    """
+    Dictionary-encodes columns of a data frame into integer codes.
+
+    Parameters:
+    ----------
+    data : pandas.DataFrame
+        The microdata.
+    variables : list of str
+        Columns to encode.
+
+    Returns:
+    -------
+    codes : list of numpy.ndarray
+        Integer codes of each column, -1 for missing values.
+    levels : list of pandas.Index
+        Sorted categories of each column, indexed by the codes.
+    """
+    codes = []
+    levels = []
+    for v in variables:
+        col_codes, col_levels = pd.factorize(data[v], sort=True)
+        codes.append(col_codes)
+        # Built from the column's own type as in grid_levels(), so that the
+        # categories have the same type as in the pandas engine
+        col_levels = pd.Series(col_levels, dtype=data[v].dtype).unique()
+        levels.append(pd.Index(col_levels))
+    return codes, levels
+
+
+def perturb_encoded(codes, shape, record_keys, pvalues, threshold, use_numba = None):
+    """
+    Counts records, sums record keys and applies perturbation and
+    suppression for every cell of the full grid of encoded variables.
+
+    Parameters:
+    ----------
+    codes : list of numpy.ndarray
+        Integer codes of each variable, -1 for missing values. Records with
+        a missing value in any variable are left out.
+    shape : tuple of int
+        Number of categories of each variable.
+    record_keys : numpy.ndarray
+        Integer record keys, with 0 for missing record keys.
+    pvalues : numpy.ndarray
+        Compiled ptable, as returned by compile_ptable().
+    threshold : integer
+        Counts below this value after perturbation are suppressed.
+    use_numba : Boolean, optional
+        Whether to use the numba kernel. Default is None, which uses it when
+        numba is installed.
+
+    Returns:
+    -------
+    dict of numpy.ndarray
+        'pre_sdc_count', 'ckey', 'pcv', 'pvalue', 'count' and 'suppressed'
+        for every cell of the grid, in sorted order.
+    """
+    if use_numba is None:
+        use_numba = HAS_NUMBA
+    if use_numba and not HAS_NUMBA:
+        raise ImportError("numba is required for the numba kernel. "
+                          "Install it with: pip install numba")
+
+    codes = np.ascontiguousarray(np.vstack(codes), dtype=np.int64)
+    shape = np.asarray(shape, dtype=np.int64)
+    record_keys = np.ascontiguousarray(record_keys, dtype=np.int64)
+    pvalues = np.ascontiguousarray(pvalues, dtype=np.int64)
+
+    if use_numba:
+        import numba
+        from cell_key_perturbation.utils.perturbation_numba import fused_kernel
+
+        grid_size = max(int(np.prod(shape)), 1)
+        n_chunks = min(numba.get_num_threads(),
+                       max(1, _MAX_ACCUMULATOR_CELLS // grid_size))
+        results = fused_kernel(codes, shape, record_keys, pvalues,
+                               threshold, n_chunks)
+    else:
+        results = _fused_numpy(codes, shape, record_keys, pvalues, threshold)
+
+    return dict(zip(("pre_sdc_count", "ckey", "pcv", "pvalue", "count", "suppressed"),
+                    results))
+
+
+def table_from_encoded(variables,
+                       codes,
+                       levels,
+                       record_keys,
+                       ptable,
+                       threshold,
+                       use_numba = None):
+    """
+    Creates a perturbed frequency table from dictionary-encoded microdata.
+    The result is identical to create_perturbed_table(), apart from any
+    extra ptable columns, which are not included.
+
+    Parameters:
+    ----------
+    variables : list of str
+        Names of the encoded variables, geog + tab_vars.
+    codes : list of numpy.ndarray
+        Integer codes of each variable, -1 for missing values.
+    levels : list of pandas.Index
+        Sorted categories of each variable.
+    record_keys : numpy.ndarray
+        Integer record keys, with 0 for missing record keys.
+    ptable : pandas.DataFrame
+        Perturbation table with 'pcv', 'ckey', and 'pvalue' columns.
+    threshold : integer
+        Counts below this value after perturbation are suppressed.
+    use_numba : Boolean, optional
+        Whether to use the numba kernel. Default is None, which uses it when
+        numba is installed.
+
+    Returns:
+    -------
+    pandas.DataFrame
+        The perturbed frequency table.
+    """
+    shape = tuple(len(level) for level in levels)
+    cells = perturb_encoded(codes, shape, record_keys, compile_ptable(ptable),
+                            threshold, use_numba = use_numba)
+
+    # Keep only the categories present in the tabulated records
+    pre_sdc_count = cells["pre_sdc_count"].reshape(shape)
+    present = []
+    for axis in range(len(shape)):
+        other_axes = tuple(a for a in range(len(shape)) if a != axis)
+        present.append(np.flatnonzero(pre_sdc_count.sum(axis=other_axes)))
+    subset = np.ix_(*present)
+    cells = {name: values.reshape(shape)[subset].ravel()
+             for name, values in cells.items()}
+
+    # The cell keys take the place of the record key sums
+    table = dense_grid_frame(variables,
+                             [level.take(keep) for level, keep in zip(levels, present)],
+                             cells["pre_sdc_count"],
+                             cells["ckey"])
+    table = table.rename(columns={"sum_rkey": "ckey"})
+    table["pcv"] = cells["pcv"]
+    table["pvalue"] = cells["pvalue"]
+    table["count"] = pd.arrays.IntegerArray(cells["count"], cells["suppressed"])
+    return table
+
+
+def _fused_numpy(codes, shape, record_keys, pvalues, threshold):
+    """
+    NumPy implementation of the fused kernel.
+    """
+    valid = np.all(codes >= 0, axis=0)
+    grid_size = int(np.prod(shape))
+    cell_index = np.ravel_multi_index(tuple(codes[:, valid]), tuple(shape))
+
+    pre_sdc_count = np.bincount(cell_index, minlength=grid_size).astype(np.int64)
+    # Sums of integer keys are exact in float64 well beyond any table size
+    sum_rkey = np.bincount(cell_index, weights=record_keys[valid],
+                           minlength=grid_size)
+    sum_rkey = np.rint(sum_rkey).astype(np.int64)
+
+    ckey = sum_rkey % pvalues.shape[1]
+    pcv = calculate_pcv(pre_sdc_count)
+    pvalue = lookup_pvalue(pvalues, pcv, ckey)
+    count = pre_sdc_count + pvalue
+    return pre_sdc_count, ckey, pcv, pvalue, count, count < threshold
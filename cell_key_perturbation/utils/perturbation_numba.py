@@ -0,0 +1,68 @@
+"""
+Compiled kernel of the fused aggregation and perturbation in
+perturbation_kernel. This module requires numba, and is only imported when
+the numba kernel is used, so that importing the package does not load numba.
+"""
+
+import numba
+import numpy as np
+
+
+@numba.njit(parallel=True, cache=True)
+def fused_kernel(codes, shape, record_keys, pvalues, threshold, n_chunks):
+    """
+    Compiled fused kernel. Records are split into n_chunks blocks, each
+    accumulated into its own arrays in parallel; the blocks are then
+    added up and perturbation is applied to each cell in parallel.
+    """
+    n_vars, n_records = codes.shape
+    grid_size = 1
+    for v in range(n_vars):
+        grid_size *= shape[v]
+
+    chunk_size = (n_records + n_chunks - 1) // n_chunks
+    local_counts = np.zeros((n_chunks, grid_size), dtype=np.int64)
+    local_sums = np.zeros((n_chunks, grid_size), dtype=np.int64)
+    for chunk in numba.prange(n_chunks):
+        for i in range(chunk * chunk_size,
+                       min(n_records, (chunk + 1) * chunk_size)):
+            cell = 0
+            valid = True
+            for v in range(n_vars):
+                code = codes[v, i]
+                if code < 0:
+                    valid = False
+                    break
+                cell = cell * shape[v] + code
+            if valid:
+                local_counts[chunk, cell] += 1
+                local_sums[chunk, cell] += record_keys[i]
+
+    modulus = pvalues.shape[1]
+    max_pcv = pvalues.shape[0]
+    pre_sdc_count = np.empty(grid_size, dtype=np.int64)
+    ckey = np.empty(grid_size, dtype=np.int64)
+    pcv = np.empty(grid_size, dtype=np.int64)
+    pvalue = np.empty(grid_size, dtype=np.int64)
+    count = np.empty(grid_size, dtype=np.int64)
+    suppressed = np.empty(grid_size, dtype=np.bool_)
+    for cell in numba.prange(grid_size):
+        n = 0
+        total_key = 0
+        for chunk in range(n_chunks):
+            n += local_counts[chunk, cell]
+            total_key += local_sums[chunk, cell]
+        pre_sdc_count[cell] = n
+        ckey[cell] = total_key % modulus
+        if n <= 750:
+            pcv[cell] = n
+        else:
+            pcv[cell] = ((n - 1) % 250) + 501
+        if pcv[cell] < max_pcv:
+            pvalue[cell] = pvalues[pcv[cell], ckey[cell]]
+        else:
+            pvalue[cell] = 0
+        count[cell] = n + pvalue[cell]
+        suppressed[cell] = count[cell] < threshold
+
+    return pre_sdc_count, ckey, pcv, pvalue, count, suppressed
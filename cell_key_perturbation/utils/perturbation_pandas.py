@@ -0,0 +1,337 @@
+import numpy as np
+import pandas as pd
+
+
+def aggregate_microdata(data, geog, tab_vars, record_key):
+    """
+    Aggregates microdata into one row per observed combination of the
+    geographic and tabulation variables.
+
+    The sum of record keys is kept as it is, before the modulo is applied, so
+    that aggregates from different sources or geography levels can be added
+    together before perturbation.
+
+    Parameters:
+    ----------
+    data : pandas.DataFrame
+        Microdata with one row per statistical unit.
+    geog : list of str
+        List of geographic variable names to group by.
+    tab_vars : list of str
+        List of tabulation variable names to group by.
+    record_key : str
+        Name of the record key column.
+
+    Returns:
+    -------
+    pandas.DataFrame
+        Aggregated table with columns geog + tab_vars, 'pre_sdc_count' and
+        'sum_rkey'. Only combinations present in the data are included.
+    """
+    aggregated_table = (
+        data.groupby(geog + tab_vars)
+            .agg(pre_sdc_count = (record_key, 'size'),
+                 sum_rkey = (record_key, 'sum'))
+            .reset_index()
+    )
+
+    # Nullable integer sums never contain missing values, use plain integers
+    if pd.api.types.is_integer_dtype(aggregated_table["sum_rkey"]):
+        aggregated_table["sum_rkey"] = aggregated_table["sum_rkey"].astype("int64")
+
+    return aggregated_table
+
+
+def grid_levels(aggregated_table, variables):
+    """
+    Returns the sorted categories of each variable in an aggregated table.
+    The full grid of the frequency table is the Cartesian product of these.
+
+    Parameters:
+    ----------
+    aggregated_table : pandas.DataFrame
+        Aggregated table containing the given variables.
+    variables : list of str
+        Variable names, in the order they appear in the frequency table.
+
+    Returns:
+    -------
+    list of pandas.Index
+        Sorted categories of each variable.
+    """
+    levels = []
+    for v in variables:
+        # factorize() also sorts object columns that mix strings and numbers
+        _, col_levels = pd.factorize(aggregated_table[v], sort=True)
+        col_levels = pd.Series(col_levels, dtype=aggregated_table[v].dtype).unique()
+        levels.append(pd.Index(col_levels))
+    return levels
+
+
+def iter_full_grid(aggregated_table, variables, chunk_size = None, levels = None):
+    """
+    Generates the full grid of all combinations of categories, in blocks of
+    rows, with the counts and record key sums from an aggregated table.
+    Combinations missing from the aggregated table get zero counts.
+
+    The full grid is never held in memory at once, only the aggregated table
+    and the current block. Blocks are produced in sorted order, so
+    concatenating them gives the same table as completing the grid in one go.
+
+    Parameters:
+    ----------
+    aggregated_table : pandas.DataFrame
+        Aggregated table with columns variables, 'pre_sdc_count' and
+        'sum_rkey', as produced by aggregate_microdata().
+    variables : list of str
+        Variable names, in the order they appear in the frequency table.
+    chunk_size : integer, optional
+        Maximum number of rows in each block. Default is None, which
+        generates the full grid as a single block.
+    levels : list of pandas.Index, optional
+        Categories of each variable. Default is None, which uses the
+        categories present in the aggregated table.
+
+    Yields:
+    ------
+    pandas.DataFrame
+        Block of the full grid with columns variables, 'pre_sdc_count' and
+        'sum_rkey'.
+    """
+    if levels is None:
+        levels = grid_levels(aggregated_table, variables)
+    shape = tuple(len(level) for level in levels)
+    grid_size = int(np.prod(shape))
+
+    # Position of each aggregated cell within the full grid
+    codes = [level.get_indexer(aggregated_table[v])
+             for v, level in zip(variables, levels)]
+    cell_index = np.ravel_multi_index(codes, shape)
+    order = np.argsort(cell_index, kind="stable")
+    cell_index = cell_index[order]
+    counts = aggregated_table["pre_sdc_count"].to_numpy()[order]
+    sums = aggregated_table["sum_rkey"].to_numpy()[order]
+
+    if chunk_size is None:
+        chunk_size = max(grid_size, 1)
+
+    # An empty grid is still returned as one empty, correctly typed block
+    for start in range(0, max(grid_size, 1), chunk_size):
+        stop = min(start + chunk_size, grid_size)
+        lo, hi = np.searchsorted(cell_index, [start, stop])
+        pre_sdc_count = np.zeros(stop - start, dtype="int64")
+        pre_sdc_count[cell_index[lo:hi] - start] = counts[lo:hi]
+        sum_rkey = np.zeros(stop - start, dtype=sums.dtype)
+        sum_rkey[cell_index[lo:hi] - start] = sums[lo:hi]
+
+        yield dense_grid_frame(variables, levels, pre_sdc_count, sum_rkey,
+                               start = start)
+
+
+def dense_grid_frame(variables, levels, pre_sdc_count, sum_rkey, start = 0):
+    """
+    Builds rows of the full grid from counts and record key sums held as
+    dense arrays, in the sorted order of the grid.
+
+    Parameters:
+    ----------
+    variables : list of str
+        Variable names, in the order they appear in the frequency table.
+    levels : list of pandas.Index
+        Sorted categories of each variable.
+    pre_sdc_count : numpy.ndarray
+        Counts for consecutive cells of the grid.
+    sum_rkey : numpy.ndarray
+        Sums of record keys for the same cells.
+    start : integer
+        Position in the full grid of the first cell. Default is 0.
+
+    Returns:
+    -------
+    pandas.DataFrame
+        Rows of the full grid with columns variables, 'pre_sdc_count' and
+        'sum_rkey'.
+    """
+    shape = tuple(len(level) for level in levels)
+    codes = np.unravel_index(np.arange(start, start + len(pre_sdc_count)),
+                             shape)
+    block = pd.DataFrame({v: level.take(code)
+                          for v, level, code in zip(variables, levels, codes)})
+    block["pre_sdc_count"] = pre_sdc_count
+    block["sum_rkey"] = sum_rkey
+    return block
+
+
+def complete_grid(aggregated_table, variables):
+    """
+    Adds zero-count rows to an aggregated table for every combination of
+    categories that is not present, and sorts it.
+
+    Parameters:
+    ----------
+    aggregated_table : pandas.DataFrame
+        Aggregated table with columns variables, 'pre_sdc_count' and
+        'sum_rkey', as produced by aggregate_microdata().
+    variables : list of str
+        Variable names, in the order they appear in the frequency table.
+
+    Returns:
+    -------
+    pandas.DataFrame
+        Full grid with columns variables, 'pre_sdc_count' and 'sum_rkey'.
+    """
+    return next(iter_full_grid(aggregated_table, variables))
+
+
+def apply_perturbation(aggregated_table, ptable, threshold):
+    """
+    Applies cell key perturbation and suppression to a table of counts and
+    record key sums.
+
+    - Applies modulo to the sum of record keys to obtain cell keys
+    - Calculates pcv by ensuring the rows of ptable 501-750 are reused for
+    cell values above 750
+    - Merges the ptable to get the perturbation value for each cell
+    - Applies the perturbation and suppresses counts below the threshold
+
+    Parameters:
+    ----------
+    aggregated_table : pandas.DataFrame
+        Table with columns for the variables, 'pre_sdc_count' and 'sum_rkey'.
+    ptable : pandas.DataFrame
+        Perturbation table with 'pcv', 'ckey', and 'pvalue' columns.
+    threshold : integer
+        Counts below this value after perturbation are set to missing.
+
+    Returns:
+    -------
+    pandas.DataFrame
+        The table with 'sum_rkey' replaced by 'ckey', and 'pcv', 'pvalue' and
+        'count' columns added.
+    """
+    #%%# Apply modulo to obtain cell keys
+    aggregated_table = aggregated_table.copy()
+    aggregated_table["sum_rkey"] = (aggregated_table["sum_rkey"]
+                                    % (ptable["ckey"].max() + 1))
+    aggregated_table = aggregated_table.rename(columns={"sum_rkey": "ckey"})
+    aggregated_table["ckey"] = aggregated_table["ckey"].astype(int)
+
+    #%%# Create pcv by ensuring the rows of ptable 501-750 are reused for cell values above 750
+    aggregated_table["pcv"] = calculate_pcv(
+        aggregated_table["pre_sdc_count"].to_numpy()
+    )
+
+    #%%# Merge aggregated table and ptable (left join) to get perturbation value for each cell
+    aggregated_table = aggregated_table.merge(ptable,
+                                              how ='left',
+                                              on = ["pcv","ckey"])
+    aggregated_table["pvalue"] = aggregated_table["pvalue"].fillna(0)
+    aggregated_table["pvalue"] = aggregated_table["pvalue"].astype(int)
+
+    #%%# Apply the perturbation and suppress counts less than the threshold
+    aggregated_table["count"] = (aggregated_table["pre_sdc_count"]
+                                 + aggregated_table["pvalue"])
+    aggregated_table["count"] = aggregated_table["count"].astype("Int64")
+    aggregated_table.loc[
+        aggregated_table["count"] < threshold,
+        "count"
+    ] = pd.NA
+
+    return aggregated_table
+
+
+def compile_ptable(ptable):
+    """
+    Converts a ptable into a dense array of perturbation values, indexed by
+    pcv and cell key, so that perturbation values can be looked up with
+    array indexing instead of a merge.
+
+    Parameters:
+    ----------
+    ptable : pandas.DataFrame
+        Perturbation table with 'pcv', 'ckey', and 'pvalue' columns.
+
+    Returns:
+    -------
+    numpy.ndarray
+        2D array where element [pcv, ckey] is the perturbation value, and 0
+        for combinations missing from the ptable. The number of columns is
+        the modulus used to obtain cell keys.
+    """
+    if (ptable["pcv"] < 0).any() or (ptable["ckey"] < 0).any():
+        raise Exception("ptable must not contain negative 'pcv' or 'ckey' "
+                        "values to be compiled.")
+    if ptable.duplicated(["pcv", "ckey"]).any():
+        raise Exception("ptable must contain each combination of 'pcv' and "
+                        "'ckey' only once.")
+
+    pcv = ptable["pcv"].to_numpy(dtype="int64")
+    ckey = ptable["ckey"].to_numpy(dtype="int64")
+    pvalues = np.zeros((pcv.max() + 1, ckey.max() + 1), dtype="int64")
+    pvalues[pcv, ckey] = ptable["pvalue"].to_numpy(dtype="int64")
+    return pvalues
+
+
+def calculate_pcv(pre_sdc_count):
+    """
+    Calculates pcv from counts, reusing the rows of ptable 501-750 for cell
+    values above 750.
+
+    Parameters:
+    ----------
+    pre_sdc_count : numpy.ndarray
+        Counts before perturbation.
+
+    Returns:
+    -------
+    numpy.ndarray
+        pcv for each count.
+    """
+    return np.where(pre_sdc_count <= 750,
+                    pre_sdc_count,
+                    ((pre_sdc_count - 1) % 250) + 501)
+
+
+def lookup_pvalue(pvalues, pcv, ckey):
+    """
+    Looks up perturbation values in a compiled ptable, giving 0 for pcv
+    values beyond the end of the ptable.
+
+    Parameters:
+    ----------
+    pvalues : numpy.ndarray
+        Compiled ptable, as returned by compile_ptable().
+    pcv : numpy.ndarray
+        pcv of each cell.
+    ckey : numpy.ndarray
+        Cell key of each cell, already reduced with the modulus.
+
+    Returns:
+    -------
+    numpy.ndarray
+        Perturbation value of each cell.
+    """
+    in_ptable = pcv < pvalues.shape[0]
+    pvalue = np.zeros(len(pcv), dtype="int64")
+    pvalue[in_ptable] = pvalues[pcv[in_ptable], ckey[in_ptable]]
+    return pvalue
+
+
+def suppress(perturbed_count, threshold):
+    """
+    Converts perturbed counts to a nullable integer array, with counts below
+    the threshold set to missing.
+
+    Parameters:
+    ----------
+    perturbed_count : numpy.ndarray
+        Counts after perturbation.
+    threshold : integer
+        Counts below this value are set to missing.
+
+    Returns:
+    -------
+    pandas.arrays.IntegerArray
+    """
+    return pd.arrays.IntegerArray(perturbed_count.astype("int64"),
+                                  perturbed_count < threshold)
@@ -0,0 +1,250 @@
+import hashlib
+import json
+import os
+import tempfile
+
+import numpy as np
+import pandas as pd
+
+import cell_key_perturbation
+from cell_key_perturbation.columnar_source import ColumnarSource, read_required_columns
+from cell_key_perturbation.prepared_microdata import PreparedMicrodata
+from cell_key_perturbation.utils.table_writers import import_pyarrow
+from cell_key_perturbation.utils.validate_inputs_before_perturbation import _check_input_data_types
+
+
+class ResultCache:
+    """
+    On-disk cache of perturbed tables, stored as Parquet files.
+
+    Cell key perturbation is deterministic, so the same inputs always give
+    the same table. Tables are stored under a fingerprint of their inputs
+    (see fingerprint_pandas() and fingerprint_bigquery()), and returned
+    from the cache when the same table is requested again.
+
+    The cache is bounded by the number of tables and optionally by their
+    total size on disk. When a bound is exceeded, the least recently used
+    tables are removed. The cache directory can be shared by several
+    processes. Requires pyarrow.
+
+    Examples
+    --------
+    >>> cache = ResultCache("ckp_cache", max_entries = 200)
+    >>> perturbed_table = create_perturbed_table(data = micro,
+    ...                                          ptable = ptable_10_5,
+    ...                                          geog = ["var1"],
+    ...                                          tab_vars = ["var5","var8"],
+    ...                                          record_key = "record_key",
+    ...                                          cache = cache)
+    """
+
+    def __init__(self, directory, max_entries = 100, max_bytes = None):
+        """
+        Parameters
+        ----------
+        directory : str
+            Location of the cache directory, which is created if it does not
+            exist.
+        max_entries : integer
+            Maximum number of tables kept in the cache. Default is 100.
+        max_bytes : integer, optional
+            Maximum total size of the cached files in bytes. Default is None,
+            which does not limit the size.
+        """
+        import_pyarrow()
+        if not isinstance(max_entries, int) or max_entries < 1:
+            raise Exception("Specified value for max_entries must be a positive integer.")
+        self.directory = directory
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        os.makedirs(directory, exist_ok=True)
+
+    def _path(self, key):
+        return os.path.join(self.directory, f"{key}.parquet")
+
+    def get(self, key):
+        """
+        Returns the cached table for a fingerprint, or None if it is not in
+        the cache.
+        """
+        path = self._path(key)
+        try:
+            table = pd.read_parquet(path)
+            # Mark the table as recently used
+            os.utime(path)
+        except FileNotFoundError:
+            return None
+        return table
+
+    def put(self, key, table):
+        """
+        Stores a table in the cache under a fingerprint, then removes the
+        least recently used tables if the cache is over its bounds.
+        """
+        # Write to a temporary file first, so readers never see a partial file
+        fd, tmp_path = tempfile.mkstemp(dir=self.directory, suffix=".tmp")
+        os.close(fd)
+        try:
+            table.to_parquet(tmp_path, index=False)
+            os.replace(tmp_path, self._path(key))
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+        self._evict()
+
+    def get_or_create(self, key, create):
+        """
+        Returns the cached table for a fingerprint. If it is not in the cache,
+        creates it by calling create() and stores it.
+        """
+        table = self.get(key)
+        if table is None:
+            table = create()
+            self.put(key, table)
+        return table
+
+    def clear(self):
+        """
+        Removes all tables from the cache.
+        """
+        for path, _, _ in self._entries():
+            _remove_if_exists(path)
+
+    def _entries(self):
+        """
+        Lists cached files with their last use time and size, oldest first.
+        """
+        entries = []
+        for name in os.listdir(self.directory):
+            if not name.endswith(".parquet"):
+                continue
+            path = os.path.join(self.directory, name)
+            try:
+                stat = os.stat(path)
+            except FileNotFoundError:
+                continue
+            entries.append((path, stat.st_mtime, stat.st_size))
+        return sorted(entries, key=lambda entry: entry[1])
+
+    def _evict(self):
+        entries = self._entries()
+        total_bytes = sum(size for _, _, size in entries)
+        while entries and (
+            len(entries) > self.max_entries
+            or (self.max_bytes is not None and total_bytes > self.max_bytes)
+        ):
+            path, _, size = entries.pop(0)
+            _remove_if_exists(path)
+            total_bytes -= size
+
+
+def fingerprint_pandas(data,
+                       ptable,
+                       geog,
+                       tab_vars,
+                       record_key,
+                       use_existing_ons_id,
+                       threshold,
+                       engine = "pandas"):
+    """
+    Creates a fingerprint of the inputs of create_perturbed_table(), from
+    the contents of the data columns used, the ptable, the table
+    specification, the threshold and the engine.
+
+    Parameters are the same as for create_perturbed_table(). data can be a
+    pandas data frame, a ColumnarSource or a PreparedMicrodata object.
+
+    Returns
+    -------
+    str
+        Hexadecimal SHA-256 fingerprint.
+    """
+    digest = _new_digest({"engine": engine,
+                          "geog": geog,
+                          "tab_vars": tab_vars,
+                          "record_key": record_key,
+                          "use_existing_ons_id": bool(use_existing_ons_id),
+                          "threshold": threshold})
+
+    if isinstance(data, PreparedMicrodata):
+        # Arrays are hashed through the buffer protocol, so memory-mapped
+        # codes and record keys are read in place rather than copied
+        digest.update(b"prepared")
+        for col in geog + tab_vars:
+            if col in data.columns:
+                digest.update(np.ascontiguousarray(data.codes(col)))
+                _update_with_frame(digest, data.levels(col).to_frame(index=False))
+        digest.update(np.ascontiguousarray(data.record_keys))
+        digest.update(json.dumps(data.stats, sort_keys=True).encode())
+    else:
+        if isinstance(data, ColumnarSource):
+            data = read_required_columns(data, geog, tab_vars, record_key,
+                                         use_existing_ons_id)
+        _check_input_data_types(data, ptable)
+        if use_existing_ons_id & ("ons_id" in data.columns):
+            key_columns = ["ons_id"]
+        else:
+            key_columns = [record_key]
+        used = [col for col in dict.fromkeys(geog + tab_vars + key_columns)
+                if col in data.columns]
+        _update_with_frame(digest, data[used])
+
+    _update_with_frame(digest, ptable)
+    return digest.hexdigest()
+
+
+def fingerprint_bigquery(client, data, ptable, query):
+    """
+    Creates a fingerprint of the inputs of create_perturbed_table_bigquery(),
+    from the query text and the last modification time of the microdata and
+    ptable tables, so no data are scanned.
+
+    Parameters
+    ----------
+    client : google.cloud.bigquery.client
+        Google Cloud BigQuery Client object
+    data : str
+        Full name of the microdata table in BigQuery.
+    ptable : str
+        Full name of the ptable in BigQuery.
+    query : str
+        The perturbation query.
+
+    Returns
+    -------
+    str
+        Hexadecimal SHA-256 fingerprint.
+    """
+    digest = _new_digest({"engine": "bigquery",
+                          "query": query,
+                          "data_modified": str(client.get_table(data).modified),
+                          "ptable_modified": str(client.get_table(ptable).modified)})
+    return digest.hexdigest()
+
+
+def _new_digest(spec):
+    """
+    Starts a fingerprint from a specification, including the package version
+    so that cached tables are not reused across versions.
+    """
+    spec = dict(spec, version=cell_key_perturbation.__version__)
+    digest = hashlib.sha256()
+    digest.update(json.dumps(spec, sort_keys=True, default=str).encode())
+    return digest
+
+
+def _update_with_frame(digest, frame):
+    """
+    Adds the column names, types and contents of a data frame to a
+    fingerprint.
+    """
+    digest.update(json.dumps([[str(col), str(dtype)]
+                              for col, dtype in frame.dtypes.items()]).encode())
+    digest.update(np.ascontiguousarray(pd.util.hash_pandas_object(frame, index=False)))
+
+
+def _remove_if_exists(path):
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
@@ -0,0 +1,165 @@
+import os
+
+FILE_FORMATS = ("parquet", "csv", "arrow")
+
+
+def open_table_writer(path, file_format):
+    """
+    Opens a writer that appends blocks of a table to a single output file.
+
+    The writer is used as a context manager, and each block is written with
+    writer.write(block) as soon as it is produced. The schema of the output
+    is taken from the first block. Blocks are written to "<path>.tmp", which
+    replaces the output file when the writer is closed, or is removed if an
+    exception is raised in the with block.
+
+    Parameters:
+    ----------
+    path : str
+        Location of the output file.
+    file_format : str
+        One of "parquet", "csv" or "arrow" (Arrow IPC file, also known as
+        Feather V2). Parquet and Arrow outputs require pyarrow.
+
+    Returns:
+    -------
+    Writer object with write(), close() and abort() methods.
+    """
+    if file_format == "csv":
+        return _CsvWriter(path)
+    if file_format in ("parquet", "arrow"):
+        return _ArrowWriter(path, file_format)
+    raise ValueError(f"Unknown file_format '{file_format}'. "
+                     f"Expected one of {list(FILE_FORMATS)}.")
+
+
+def import_pyarrow():
+    """
+    Imports pyarrow, which is only required for Parquet and Arrow files.
+    """
+    try:
+        import pyarrow
+    except ImportError as e:
+        raise ImportError("pyarrow is required to read or write Parquet and "
+                          "Arrow files. Install it with: pip install pyarrow") from e
+    return pyarrow
+
+
+class _TableWriter:
+    """
+    Base class of the writers. Blocks are written to a temporary file in the
+    same directory, which replaces the output file only when the writer is
+    closed without an error, so a failed run never leaves a partial output
+    that looks complete.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.tmp_path = path + ".tmp"
+
+    def close(self):
+        self._finish()
+        if os.path.exists(self.tmp_path):
+            os.replace(self.tmp_path, self.path)
+
+    def abort(self):
+        """
+        Discards the blocks written so far, leaving any existing output file
+        unchanged.
+        """
+        try:
+            self._finish()
+        finally:
+            if os.path.exists(self.tmp_path):
+                os.remove(self.tmp_path)
+
+    def _finish(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+
+class _CsvWriter(_TableWriter):
+    """
+    Appends blocks of a table to a CSV file, writing the header once.
+    """
+    def __init__(self, path):
+        super().__init__(path)
+        self._started = False
+
+    def write(self, block):
+        # The first block starts a new file, later blocks are appended
+        block.to_csv(self.tmp_path, mode="a" if self._started else "w",
+                     header=not self._started, index=False)
+        self._started = True
+
+
+class _ArrowWriter(_TableWriter):
+    """
+    Appends blocks of a table to a Parquet or Arrow IPC file as separate
+    row groups or record batches.
+    """
+    def __init__(self, path, file_format):
+        super().__init__(path)
+        self.file_format = file_format
+        self._pa = import_pyarrow()
+        self._schema = None
+        self._writer = None
+
+    def write(self, block):
+        pa = self._pa
+        table = pa.Table.from_pandas(block, schema=self._schema,
+                                     preserve_index=False)
+        if self._writer is None:
+            self._schema = table.schema
+            if self.file_format == "parquet":
+                import pyarrow.parquet as pq
+                self._writer = pq.ParquetWriter(self.tmp_path, self._schema)
+            else:
+                self._writer = pa.ipc.new_file(self.tmp_path, self._schema)
+        self._writer.write_table(table)
+
+    def _finish(self):
+        if self._writer is not None:
+            self._writer.close()
+            self._writer = None
+
+
+def write_blocks(blocks, path, file_format):
+    """
+    Writes an iterable of table blocks to a single output file.
+
+    Parameters:
+    ----------
+    blocks : iterable of pandas.DataFrame
+        Blocks of the table, all with the same columns.
+    path : str
+        Location of the output file.
+    file_format : str
+        One of "parquet", "csv" or "arrow".
+
+    Returns:
+    -------
+    int
+        Total number of rows written.
+    """
+    n_rows = 0
+    empty_block = None
+    with open_table_writer(path, file_format) as writer:
+        for block in blocks:
+            if len(block.index) == 0:
+                empty_block = block
+                continue
+            writer.write(block)
+            n_rows += len(block.index)
+
+        # An empty table is still written, with its header or schema
+        if n_rows == 0 and empty_block is not None:
+            writer.write(empty_block)
+    return n_rows
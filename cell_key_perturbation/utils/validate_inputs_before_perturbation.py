@@ -7,6 +7,8 @@ Created on Thu Oct  9 10:43:53 2025
 
 import pandas as pd
 
+from cell_key_perturbation.utils.generate_record_key import record_key_sql_expression
+
 #%%# High level validation function
 
 def validate_inputs(data, ptable, geog, tab_vars, record_key, threshold):
@@ -53,7 +55,7 @@ def validate_inputs(data, ptable, geog, tab_vars, record_key, threshold):
     
     # Check data has sufficient % records with record keys to apply perturbation
     rkey_nan_count = data[record_key].isna().sum()
-    rkey_percent = 100 * (1 - rkey_nan_count / len(data))
+    rkey_percent = _record_key_percent(rkey_nan_count, len(data))
     
     _check_missing_record_key(rkey_nan_count, rkey_percent)
         
@@ -161,7 +163,7 @@ def validate_inputs_bigquery(client,
     if use_existing_ons_id & ("ons_id" in existing_columns):
         range_query = range_query.replace(
             f"SAFE_CAST({record_key} AS INT64)",
-            "MOD(SAFE_CAST(ons_id AS INT64), 4096)"
+            record_key_sql_expression()
             )
     keys_range = client.query(range_query).to_dataframe()
 
@@ -178,13 +180,13 @@ def validate_inputs_bigquery(client,
     SELECT
         COUNT(*) AS total_records,
         COUNTIF({record_key} IS NULL) AS null_record_keys,
-        ROUND(100.0 * COUNTIF({record_key} IS NOT NULL) / COUNT(*), 2) AS percent_with_keys
+        IFNULL(ROUND(100.0 * SAFE_DIVIDE(COUNTIF({record_key} IS NOT NULL), COUNT(*)), 2), 100) AS percent_with_keys
     FROM `{data}`;
     """
     if use_existing_ons_id & ("ons_id" in existing_columns):
         records_key_query = records_key_query.replace(
             f"{record_key}",
-            "MOD(SAFE_CAST(ons_id AS INT64), 4096)"
+            record_key_sql_expression()
             )
     rkey = client.query(records_key_query).to_dataframe()
     
@@ -197,6 +199,235 @@ def validate_inputs_bigquery(client,
     print("Input validation completed.")
 
 
+#%%# Validation with Spark
+
+def validate_inputs_spark(data, ptable, geog, tab_vars, record_key, threshold):
+    """
+    Validates Spark inputs for a perturbation process.
+    
+    The checks are the same as for validate_inputs(). The range of record 
+    keys and the number of missing record keys are computed with a single 
+    aggregation over the data, which runs on the executors, so only the 
+    results are returned to the driver.
+
+    Parameters:
+    - data (pyspark.sql.DataFrame): The main dataset
+    - ptable (pyspark.sql.DataFrame): Perturbation table with 'pcv', 'ckey', and 'pvalue' columns
+    - geog (list): List of geographic variables
+    - tab_vars (list): List of tabulation variables
+    - record_key (str): Column name for the record key
+    - threshold (int): Threshold value for perturbation
+
+    Raises:
+    - TypeError, Exception or Warning message if any validation fails.
+    """
+    from pyspark.sql import DataFrame, functions as F
+    
+    if not isinstance(data, DataFrame):
+        raise TypeError("Specified value for data must be a Spark DataFrame.")
+    if not isinstance(ptable, DataFrame):
+        raise TypeError("Specified value for ptable must be a Spark DataFrame.")
+    
+    _check_input_arguments(geog, tab_vars, record_key, threshold)
+    _check_input_data_contain_columns(data, ptable, geog, tab_vars, record_key)
+    
+    
+    # Check if the range of record keys and cell keys match
+    rkey = F.col(record_key)
+    data_stats = data.agg(F.min(rkey).alias("min_rkey"),
+                          F.max(rkey).alias("max_rkey"),
+                          F.count(F.lit(1)).alias("n_records"),
+                          F.count(rkey).alias("n_with_rkey")).first()
+    ptable_stats = ptable.agg(F.min("ckey").alias("min_ckey"),
+                              F.max("ckey").alias("max_ckey")).first()
+    
+    # Spark gives null for the keys of data without record keys, pandas NaN
+    min_rkey, max_rkey = (float("nan") if value is None else value
+                          for value in (data_stats["min_rkey"], data_stats["max_rkey"]))
+    _check_key_range(ptable_stats["min_ckey"], ptable_stats["max_ckey"],
+                     min_rkey, max_rkey)
+    
+    
+    # Check data has sufficient % records with record keys to apply perturbation
+    rkey_nan_count = data_stats["n_records"] - data_stats["n_with_rkey"]
+    rkey_percent = _record_key_percent(rkey_nan_count, data_stats["n_records"])
+    
+    _check_missing_record_key(rkey_nan_count, rkey_percent)
+    
+    
+    print("Input validation completed.")
+
+
+#%%# Validation of prepared microdata
+
+def validate_inputs_prepared(prepared, ptable, geog, tab_vars, threshold):
+    """
+    Validates inputs for a perturbation process on prepared microdata.
+    
+    The checks are the same as for validate_inputs(), but the statistics on 
+    record keys are taken from those computed when the microdata were 
+    prepared, so the data are not scanned again.
+
+    Parameters:
+    - prepared (PreparedMicrodata): The prepared dataset
+    - ptable (pd.DataFrame): Perturbation table with 'pcv', 'ckey', and 'pvalue' columns
+    - geog (list): List of geographic variables
+    - tab_vars (list): List of tabulation variables
+    - threshold (int): Threshold value for perturbation
+
+    Raises:
+    - TypeError, Exception or Warning message if any validation fails.
+    """
+    if not isinstance(ptable, pd.DataFrame):
+        raise TypeError("Specified value for ptable must be a Pandas DataFrame.")
+    _check_input_arguments(geog, tab_vars, prepared.record_key, threshold)
+    
+    # Check geog & tab_vars were encoded when the data were prepared
+    if geog and not all(item in prepared.columns for item in geog):
+        raise Exception("Specified value(s) for geog must be column(s) in data.")
+    if tab_vars and not all(item in prepared.columns for item in tab_vars):
+        raise Exception("Specified value(s) for tab_vars must be column(s) in data.")
+    
+    required_ptable_cols = {"pcv", "ckey", "pvalue"}
+    if not required_ptable_cols.issubset(ptable.columns):
+        raise Exception("Supplied ptable must contain columns named 'pcv', 'ckey' and 'pvalue'.")
+    
+    stats = prepared.stats
+    _check_key_range(ptable["ckey"].min(), ptable["ckey"].max(),
+                     stats["min_rkey"], stats["max_rkey"])
+    
+    rkey_nan_count = stats["rkey_nan_count"]
+    rkey_percent = _record_key_percent(rkey_nan_count, stats["n_records"])
+    
+    _check_missing_record_key(rkey_nan_count, rkey_percent)
+    
+    print("Input validation completed.")
+
+
+#%%# Validation of pre-aggregated data
+
+def validate_inputs_aggregated(data, 
+                               ptable, 
+                               geog, 
+                               tab_vars, 
+                               count_col, 
+                               rkey_sum_col, 
+                               rkey_count_col, 
+                               threshold):
+    """
+    Validates pre-aggregated inputs for a perturbation process.
+
+    - Type validation on input data & ptable
+    - Validate other input arguments
+        - Check that geog and tab_vars are lists of strings
+        - Check that at least one variable specified for geog or tab_vars
+        - Check threshold is an integer
+    - Validate aggregated data and ptable contain required columns
+    - Check counts are non-negative integers and record key sums are not missing
+    - Validate data has sufficient % records with record keys to apply 
+    perturbation, if the number of records with a record key is supplied
+
+    The range of record keys cannot be checked against the range of cell keys,
+    as only the sums of record keys are available.
+
+    Parameters:
+    - data (pd.DataFrame): Aggregated data with one row per cell
+    - ptable (pd.DataFrame): Perturbation table with 'pcv', 'ckey', and 'pvalue' columns
+    - geog (list): List of geographic variables
+    - tab_vars (list): List of tabulation variables
+    - count_col (str): Column name for the number of records in each cell
+    - rkey_sum_col (str): Column name for the sum of record keys in each cell
+    - rkey_count_col (str or None): Column name for the number of records with 
+    a record key in each cell
+    - threshold (int): Threshold value for perturbation
+
+    Raises:
+    - TypeError, Exception or Warning message if any validation fails.
+    """
+    count_cols = [count_col] + ([rkey_count_col] if rkey_count_col else [])
+    
+    _check_input_data_types(data, ptable)
+    _check_input_arguments(geog, tab_vars, rkey_sum_col, threshold)
+    for col in count_cols + [rkey_sum_col]:
+        if col not in data.columns:
+            raise Exception(f"Specified column '{col}' must be a column in data.")
+    _check_input_data_contain_columns(data, ptable, geog, tab_vars, rkey_sum_col)
+    
+    for col in count_cols:
+        if not pd.api.types.is_integer_dtype(data[col]):
+            raise TypeError(f"Column '{col}' must contain integer counts.")
+        if (data[col] < 0).any():
+            raise Exception(f"Column '{col}' must not contain negative counts.")
+    
+    if data[rkey_sum_col].isna().any():
+        raise Exception(f"Column '{rkey_sum_col}' must not contain missing "
+                        "values. Use 0 for cells without record keys.")
+    
+    # Check data has sufficient % records with record keys to apply perturbation
+    if rkey_count_col:
+        total_records = data[count_col].sum()
+        rkey_nan_count = total_records - data[rkey_count_col].sum()
+        rkey_percent = _record_key_percent(rkey_nan_count, total_records)
+        
+        _check_missing_record_key(rkey_nan_count, rkey_percent)
+    
+    print("Input validation completed.")
+
+
+def validate_geog_lookup(geog_lookup, finest_geog, geog_levels, finest_codes):
+    """
+    Validates a geography lookup used to roll up tables from the finest 
+    geography level to coarser levels.
+    
+    - Check geog_lookup is a DataFrame containing finest_geog and geog_levels
+    - Check each finest geography code maps to a single code at each level
+    - Check no finest geography code in the data is missing
+    - Check all finest geography codes in the data are in the lookup, with a
+    code at every level
+    
+    Parameters:
+    - geog_lookup (pd.DataFrame): Lookup with one column per geography level
+    - finest_geog (str): Column name of the finest geography level
+    - geog_levels (list): Column names of the geography levels to tabulate
+    - finest_codes (pd.Series): Finest geography codes present in the data
+    
+    Raises:
+    - TypeError or Exception if any validation fails.
+    """
+    if not isinstance(geog_lookup, pd.DataFrame):
+        raise TypeError("Specified value for geog_lookup must be a Pandas DataFrame.")
+    if not isinstance(geog_levels, list) or len(geog_levels) == 0:
+        raise TypeError("Expected 'geog_levels' to be a non-empty list!")
+    
+    missing = [col for col in [finest_geog] + geog_levels 
+               if col not in geog_lookup.columns]
+    if missing:
+        raise Exception(f"Missing columns in geog_lookup: {missing}")
+    
+    levels = list(dict.fromkeys([finest_geog] + geog_levels))
+    lookup = geog_lookup[levels].drop_duplicates()
+    if lookup[finest_geog].duplicated().any():
+        raise Exception(f"Each '{finest_geog}' code must map to a single code "
+                        "at each geography level in geog_lookup.")
+    
+    # Records without a code would be left out of every coarser table
+    finest_codes = pd.Series(finest_codes)
+    if finest_codes.isna().any():
+        raise Exception(f"Every record in data must have a '{finest_geog}' code "
+                        "to be rolled up to coarser geography levels.")
+    
+    unmatched = set(finest_codes) - set(lookup[finest_geog])
+    if unmatched:
+        raise Exception(f"{len(unmatched)} '{finest_geog}' code(s) in data are "
+                        "missing from geog_lookup.")
+    
+    used = lookup[lookup[finest_geog].isin(finest_codes)]
+    unmapped = [level for level in levels if used[level].isna().any()]
+    if unmapped:
+        raise Exception(f"Some '{finest_geog}' code(s) in data have no code in "
+                        f"geog_lookup at the geography level(s): {unmapped}")
+
+
 #%%# Low level validation functions
 
 def _check_input_data_types(data, ptable):
@@ -259,6 +490,22 @@ def _check_input_arguments(geog, tab_vars, record_key, threshold):
         raise Exception("Specified value for threshold must be an integer.")
 
 
+def _record_key_percent(rkey_nan_count, n_records):
+    """
+    Percentage of records with a record key
+    
+    Parameters:
+    - rkey_nan_count (int): Number of missing record keys
+    - n_records (int): Number of records
+    
+    Returns:
+    float, 100 if there are no records, as no record key is missing
+    """
+    if n_records == 0:
+        return 100.0
+    return 100 * (1 - rkey_nan_count / n_records)
+
+
 def _check_missing_record_key(rkey_nan_count, rkey_percent):
     """
     Generates exception or warning message depending on the rate of missing record keys
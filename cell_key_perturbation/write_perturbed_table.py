@@ -0,0 +1,150 @@
+from cell_key_perturbation.utils.perturbation_pandas import (
+    aggregate_microdata, iter_full_grid, apply_perturbation
+)
+from cell_key_perturbation.utils.table_writers import FILE_FORMATS, write_blocks
+from cell_key_perturbation.utils.validate_inputs_before_perturbation import validate_inputs
+from cell_key_perturbation.utils.generate_record_key import generate_record_key_from_ons_id
+from cell_key_perturbation.columnar_source import ColumnarSource, read_required_columns
+
+def iter_perturbed_table(data,
+                         ptable,
+                         geog,
+                         tab_vars,
+                         record_key,
+                         use_existing_ons_id = True,
+                         threshold = 10,
+                         chunk_size = 1_000_000
+                         ):
+    """
+    Function creates a frequency table which has has a cell key perturbation
+    technique applied with help from a p-table, and returns it in blocks of
+    rows rather than as a single data frame.
+
+    The microdata are aggregated once to the cells that are present in the
+    data. The full grid of all combinations of categories is then generated
+    block by block, and perturbation and suppression are applied to each
+    block. Only the aggregated cells and one block are held in memory at a
+    time, so memory does not depend on the size of the full grid.
+
+    Concatenating the blocks gives the same table as create_perturbed_table().
+
+    Parameters
+    ----------
+    data : Pandas data frame
+    A pandas data frame containing the data to be tabulated and perturbed,
+    or a ColumnarSource.
+
+    ptable: Pandas data frame
+    A pandas data frame containing the 'ptable' file.
+
+    geog : Vector
+    A vector with one entry, the column name in 'data' that contains the
+    desired geography level for the frequency table, or an empty vector: []
+
+    tab_vars: Vector
+    A vector containing the column names in 'data' of the variables to be
+    tabulated.
+
+    record_key: String
+    The column name in 'data' that contains the record keys required for
+    perturbation. Set (record_key = None) if record keys will be generated
+    from "ons_id".
+
+    use_existing_ons_id: Boolean
+    Whether to create record keys from ons_id, if ons_id exists in data.
+    Default is True.
+
+    threshold: Integer
+    Threshold below which cell counts are supressed. Default is 10.
+
+    chunk_size: Integer
+    Maximum number of rows of the frequency table in each block.
+    Default is 1,000,000.
+
+    Yields
+    -------
+    block: Pandas data frame
+    Consecutive rows of the perturbed frequency table, in the same format as
+    the output of create_perturbed_table().
+    """
+    #%%# Read only the required columns from a columnar source
+    if isinstance(data, ColumnarSource):
+        data = read_required_columns(data, geog, tab_vars, record_key,
+                                     use_existing_ons_id)
+
+    #%%# Generate record keys from "ons_id" if exists
+    if use_existing_ons_id & ("ons_id" in data.columns):
+        print('NOTE: "ons_id" column is available in data!',
+              'Generating record keys from "ons_id"!')
+
+        data = generate_record_key_from_ons_id(data,
+                                               record_key_col="ons_record_key")
+        record_key = "ons_record_key"
+
+    #%%# Step 0: Validate Inputs
+    validate_inputs(data, ptable, geog, tab_vars, record_key, threshold)
+
+    #%%# Step 1: Aggregate the cells present in the data
+    aggregated_table = aggregate_microdata(data, geog, tab_vars, record_key)
+
+    #%%# Step 2: Complete the grid and apply perturbation block by block
+    for block in iter_full_grid(aggregated_table,
+                                geog + tab_vars,
+                                chunk_size = chunk_size):
+        block = apply_perturbation(block, ptable, threshold)
+        yield block
+
+
+def write_perturbed_table(data,
+                          ptable,
+                          geog,
+                          tab_vars,
+                          record_key,
+                          path,
+                          file_format = "parquet",
+                          use_existing_ons_id = True,
+                          threshold = 10,
+                          chunk_size = 1_000_000
+                          ):
+    """
+    Function creates a frequency table which has has a cell key perturbation
+    technique applied with help from a p-table, and writes it to a file block
+    by block, without holding the full table in memory.
+
+    Parameters are the same as for iter_perturbed_table(), plus:
+
+    path: String
+    Location of the output file.
+
+    file_format: String
+    One of "parquet", "csv" or "arrow" (Arrow IPC / Feather V2).
+    Parquet and Arrow outputs require pyarrow. Default is "parquet".
+
+    Returns
+    -------
+    n_rows: Integer
+    Number of rows written to the output file.
+
+    Examples
+    --------
+    >>> n_rows = write_perturbed_table(data = micro,
+    ...                                ptable = ptable_10_5,
+    ...                                geog = ["var1"],
+    ...                                tab_vars = ["var5","var8"],
+    ...                                record_key = "record_key",
+    ...                                path = "perturbed_table.parquet")
+    """
+    if file_format not in FILE_FORMATS:
+        raise ValueError(f"Unknown file_format '{file_format}'. "
+                         f"Expected one of {list(FILE_FORMATS)}.")
+
+    blocks = iter_perturbed_table(data = data,
+                                  ptable = ptable,
+                                  geog = geog,
+                                  tab_vars = tab_vars,
+                                  record_key = record_key,
+                                  use_existing_ons_id = use_existing_ons_id,
+                                  threshold = threshold,
+                                  chunk_size = chunk_size)
+
+    return write_blocks(blocks, path, file_format)